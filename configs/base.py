@@ -1,17 +1,62 @@
 import dspy
-from typing import Optional
+from typing import Dict, List, Optional, Union
 import dspy.primitives
 import dspy.primitives.program
 from serde import serde
 from functools import partial
 
+@serde
+class ConcurrencySettings():
+    initial_limit: int = 8
+    min_limit: int = 1
+    max_limit: int = 64
+    # Seconds, slower calls shrink the in-flight limit like errors do
+    latency_target: float = 30.0
+    backoff: float = 0.5
+
+@serde
+class EjectionSettings():
+    # Consecutive connection/server errors before a replica is ejected
+    max_failures: int = 3
+    ejection_seconds: float = 30.0
+
 @serde
 class ModelSettings():
     model: str
-    api_base: str
+    # Several api_bases are replicas of the same model, balanced by utils/balancer.py
+    api_base: Union[str, List[str]]
     model_type: str
     cache: bool
     api_key: Optional[str] = None
+    # Return token logprobs, needed for cascade confidences
+    logprobs: bool = False
+    concurrency: Optional[ConcurrencySettings] = None
+    ejection: Optional[EjectionSettings] = None
+
+@serde
+class ScoreStoreSettings():
+    path: str
+    max_entries: Optional[int] = 1_000_000
+    ttl_seconds: Optional[float] = None
+
+@serde
+class CascadeSettings():
+    # Model every field is scored with first, escalating to model_settings when unsure
+    small_model_settings: ModelSettings
+    # JSON of per-field confidence thresholds, written by fit_cascade_thresholds.py
+    thresholds_path: Optional[str] = None
+    default_threshold: float = 0.9
+
+@serde
+class RecommendationPrioritySettings():
+    # Impact weight per field, on top of the defaults in models/recommender_v2.py
+    weights: Optional[Dict[str, float]] = None
+    # Only the highest priority flagged fields get a recommendation
+    max_recommendations: Optional[int] = None
+    # Seconds, recommendations still running after it are dropped or deferred
+    latency_budget: Optional[float] = None
+    # Dropped recommendations still complete in the background, after the others
+    background: bool = False
 
 @serde
 class Config():
@@ -39,3 +84,36 @@ class Config():
     scorer_model_uri: Optional[str] = None
     predict_module: type[dspy.primitives.program.Module] = dspy.Predict
     checkpoint_path: Optional[str] = None
+
+    # Fused scoring: group name -> fields scored together in a single LM call,
+    # None keeps the groups of a loaded checkpoint
+    scorer_groups: Optional[Dict[str, List[str]]] = None
+    # Skip fields whose gating fields (field_dependencies) make them irrelevant,
+    # fields in scorer_groups are always scored
+    lazy_scoring: bool = False
+    # Persistent store of parsed scores, consulted before calling the LM
+    score_store: Optional[ScoreStoreSettings] = None
+    # Local fields scored sentence by sentence, e.g. grammatical_errors
+    chunked_fields: Optional[List[str]] = None
+    # Fields decided by deterministic detectors (models/prefilter.py) when they are confident
+    prefilter_fields: Optional[List[str]] = None
+    # Score with a small model first, escalate low confidence answers to model_settings
+    cascade: Optional[CascadeSettings] = None
+    # Score single fields from the logprobs of one answer token instead of generating text
+    classification_scoring: bool = False
+    # Constrain completions to the signature's output schema with vLLM guided decoding
+    guided_decoding: bool = False
+    # Thread pool size of the sync forward of the scorer and recommender
+    sync_workers: int = 8
+    # LM calls in flight across all the samples of a batch (run_batch)
+    batch_concurrency: int = 32
+    # Fixed-text recommendations come from templates (models/recommender_v2.py), not the LM
+    recommendation_templates: bool = False
+    # Flagged fields get their recommendations from one FusedRecommender call instead of one call each
+    fused_recommendations: bool = False
+    # Ranking, top-k and latency budget of the recommendations of a response
+    recommendation_priority: Optional[RecommendationPrioritySettings] = None
+    # The reconciliator emits edits applied with diff-match-patch instead of rewriting the response
+    patch_reconciliation: bool = False
+    # evaluate_recommendations.py reconciles with the streaming variant, timing the first chunk
+    stream_reconciliation: bool = False
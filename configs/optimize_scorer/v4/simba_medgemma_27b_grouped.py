@@ -0,0 +1,29 @@
+from configs.base import Config, ModelSettings
+from models.prompt_score_v4 import evaluator_groups
+from optimizers.simba_optimizer import SimbaOptimizer
+from functools import partial
+
+NAME = "simba_medgemma_27b_grouped"
+
+config = Config(
+    seed=42,
+    mlflow_url="http://localhost:5000",
+    experiment_name="doctor-copilot-optimization",
+    run_name=NAME,
+    limit=100,
+    model_settings=ModelSettings(
+        model="hosted_vllm/google/medgemma-27b-text-it",
+        api_base="http://localhost:8000/v1",
+        model_type="chat",
+        api_key="o-parola",
+        cache=True,
+    ),
+    train_path="sets/annotated/manual/v4/annotated-average-train.csv",
+    val_path="sets/annotated/manual/v4/annotated-average-test.csv",
+    test_path=None,
+    predict_path=None,
+    output_path=f"sets/annotated/optimized/{NAME}/results.json",
+    optimizer=partial(SimbaOptimizer),
+    checkpoint_path=f"checkpoints/{NAME}",
+    scorer_groups=evaluator_groups,
+)
@@ -0,0 +1,39 @@
+import dspy
+from configs.base import CascadeSettings, Config, ModelSettings
+
+NAME = "cascade_gemma_12b_medgemma_27b"
+
+config = Config(
+    seed=42,
+    mlflow_url="http://localhost:5000",
+    experiment_name="doctor-copilot-optimization",
+    run_name=NAME,
+    limit=100,
+    model_settings=ModelSettings(
+        model="hosted_vllm/google/medgemma-27b-text-it",
+        api_base="http://localhost:8003/v1",
+        model_type="chat",
+        api_key="o-parola",
+        cache=True,
+    ),
+    cascade=CascadeSettings(
+        small_model_settings=ModelSettings(
+            model="hosted_vllm/google/gemma-3-12b-it",
+            api_base="http://localhost:8000/v1",
+            model_type="chat",
+            api_key="o-parola",
+            cache=True,
+        ),
+        # python fit_cascade_thresholds.py sets/annotated/optimized/simba_gemma_12b_logprobs/results.json \
+        #     checkpoints/cascade_thresholds.json --large-results sets/annotated/optimized/simba_medgemma_27b_full_dataset/results.json
+        thresholds_path="checkpoints/cascade_thresholds.json",
+    ),
+    scorer_model_uri=None,
+    train_path=None,
+    val_path=None,
+    test_path=None,
+    predict_module=dspy.Predict,
+    predict_path="sets/annotated/manual/v4/annotated-average-test.csv",
+    output_path=f"sets/recommendations/{NAME}/results.json",
+    checkpoint_path="checkpoints/simba_medgemma_27b_full_dataset"
+)
@@ -11,7 +11,8 @@ class PromptScoreV2Loader():
         self.test_path = cfg.test_path
         self.predict_path = cfg.predict_path
 
-    def train_dataloader(self, field) -> List[dspy.Example]:
+    def train_dataloader(self, field: str | List[str]) -> List[dspy.Example]:
+        fields = [field] if isinstance(field, str) else field
         df = pl.read_csv(self.train_path).limit(self.cfg.limit)
         trainset = []
         for row in df.iter_rows(named=True):
@@ -19,11 +20,12 @@ class PromptScoreV2Loader():
                 base_id=row['base_id'],
                 patient_question=row['patient_question'],
                 doctor_response=row['doctor_response'],
-                **{field: row[field]}
+                **{f: row[f] for f in fields}
             ).with_inputs("patient_question", "doctor_response"))
         return trainset
         
-    def val_dataloader(self, field) -> List[dspy.Example]:
+    def val_dataloader(self, field: str | List[str]) -> List[dspy.Example]:
+        fields = [field] if isinstance(field, str) else field
         df = pl.read_csv(self.val_path).limit(self.cfg.limit)
         valset = []
         for row in df.iter_rows(named=True):
@@ -31,7 +33,7 @@ class PromptScoreV2Loader():
                 base_id=row['base_id'],
                 patient_question=row['patient_question'],
                 doctor_response=row['doctor_response'],
-                **{field: row[field]}
+                **{f: row[f] for f in fields}
             ).with_inputs("patient_question", "doctor_response"))
         return valset
 
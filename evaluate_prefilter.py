@@ -0,0 +1,89 @@
+import dspy
+import asyncio
+import argparse
+import logging
+import polars as pl
+from importlib import import_module
+from tqdm import tqdm
+from models.prefilter import Prefilter, detectors
+from configs.base import Config
+from utils.lm import build_lm
+
+logging.getLogger("LiteLLM").setLevel(logging.CRITICAL)
+logging.getLogger("httpx").setLevel(logging.CRITICAL)
+
+
+def path_to_module(path: str):
+    """
+    Converts a file path to a Python module path.
+    """
+    return path.rstrip(".py").replace("/", ".")
+
+
+def agreement(pairs):
+    pairs = [(a, b) for a, b in pairs if a is not None and b is not None]
+    if not pairs:
+        return None
+    return sum(a == b for a, b in pairs) / len(pairs)
+
+
+async def main():
+    parser = argparse.ArgumentParser(
+        description="Report prefilter skip rates and agreement on an annotated CSV"
+    )
+    parser.add_argument("config_path", help="Path to the config file")
+    parser.add_argument("--csv", help="Annotated CSV, defaults to the config's val_path")
+    parser.add_argument(
+        "--llm",
+        action="store_true",
+        help="Also score the decided fields with the config's checkpoint",
+    )
+    args = parser.parse_args()
+
+    cfg: Config = import_module(path_to_module(args.config_path)).config
+    fields = cfg.prefilter_fields or list(detectors)
+    prefilter = Prefilter(fields)
+
+    if args.llm:
+        dspy.settings.configure(lm=build_lm(cfg.model_settings))
+        scorer = dspy.load(cfg.checkpoint_path)
+        scorer.apply_config(cfg)
+        scorer.prefilter = None
+
+    df = pl.read_csv(args.csv or cfg.val_path).limit(cfg.limit)
+    gold_pairs = {field: [] for field in prefilter.detectors}
+    llm_pairs = {field: [] for field in prefilter.detectors}
+
+    for row in tqdm(df.iter_rows(named=True), total=len(df)):
+        decisions = {}
+        for field in prefilter.detectors:
+            value = prefilter.decide(field, row["patient_question"], row["doctor_response"])
+            if value is not None:
+                decisions[field] = value
+                gold_pairs[field].append((value, row.get(field)))
+
+        if args.llm and decisions:
+            scores = await scorer.aforward(
+                patient_question=row["patient_question"],
+                doctor_response=row["doctor_response"],
+                fields_to_score=list(decisions),
+            )
+            for field, value in decisions.items():
+                llm_pairs[field].append((value, scores[field]))
+
+    skip_rates = prefilter.skip_rates()
+    print(f"{'field':<22}{'skip rate':>10}{'gold agr.':>11}{'llm agr.':>10}")
+    for field in prefilter.detectors:
+        metrics = [
+            skip_rates.get(field),
+            agreement(gold_pairs[field]),
+            agreement(llm_pairs[field]),
+        ]
+        print(f"{field:<22}" + "".join(
+            f"{value:>10.3f} " if value is not None else f"{'-':>10} "
+            for value in metrics
+        ))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
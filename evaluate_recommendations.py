@@ -1,20 +1,23 @@
 import dspy
-import json
+import asyncio
+import time
 import argparse
 import mlflow
 import logging
-from serde import to_dict
 from importlib import import_module
-from tqdm import tqdm
-from pathlib import Path
 from models.prompt_score_v4 import (
     DoctorResponseScorerModule,
     field_to_evaluator,
     metric_map,
 )
-from models.recommender_v2 import RecommenderModule
-from models.reconciliator import ReconciliatorModule
+from models.recommender_v2 import RecommenderModule, scheduler_stats
+from models.reconciliator import ReconciliatorModule, reconciliation_stats
+from models.adapters import adapter_stats, build_adapter
 from configs.base import Config
+from utils.balancer import balancer_stats
+from utils.concurrency import run_resumable
+from utils.jsonl import jsonl_to_json
+from utils.lm import shared_lm
 from dataloaders.recommendation_loader import RecommendationLoader
 
 logging.getLogger("LiteLLM").setLevel(logging.CRITICAL)
@@ -28,7 +31,13 @@ def path_to_module(path: str):
     return path.rstrip(".py").replace("/", ".")
 
 
-def main():
+def percentile(values, q):
+    """Nearest-rank percentile, q in [0, 100]."""
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q / 100))]
+
+
+async def main():
     parser = argparse.ArgumentParser(description="Optimize evaluator models")
     parser.add_argument("config_path", help="Path to the config file")
     args = parser.parse_args()
@@ -40,64 +49,149 @@ def main():
     mlflow.set_experiment(cfg.experiment_name)
     mlflow.dspy.autolog()
 
-    dspy.settings.configure(lm=dspy.LM(**to_dict(cfg.model_settings)))
+    dspy.settings.configure(
+        lm=shared_lm(cfg.model_settings), adapter=build_adapter(cfg.guided_decoding)
+    )
     # scorer = DoctorResponseScorerModule(cfg)
     assert cfg.scorer_model_uri
-    scorer = mlflow.pyfunc.load_model(cfg.scorer_model_uri)
+    scorer = mlflow.dspy.load_model(cfg.scorer_model_uri)
+    scorer.apply_config(cfg)
     recommender = RecommenderModule(cfg)
     response_reconciliator = ReconciliatorModule(cfg)
     dataloader = RecommendationLoader(cfg)
     predict_loader = dataloader.predict_dataloader()
 
-    results = []
+    # Seconds spent in each stage, per evaluated sample
+    stages = ["score", "recommend", "reconcile", "rescore"]
+    if cfg.stream_reconciliation:
+        # Seconds until the first chunk of the reconciled response
+        stages.append("first_chunk")
+    stage_latencies = {stage: [] for stage in stages}
 
-    with mlflow.start_run(run_name=cfg.run_name):
-        # Process each sample
-        print(f"\n\n{'='*50}")
-        print(f"Evaluating recommender")
-        print(f"{'='*50}")
-        for sample in tqdm(predict_loader):
-            base_score = scorer.predict(
-                {
-                    "patient_question": sample.patient_question,
-                    "doctor_response": sample.doctor_response,
-                }
-            )
-            recommendations = recommender(
-                field="all",
-                score=base_score,
-                patient_question=sample.patient_question,
-                doctor_response=sample.doctor_response,
-            )
-            modifier_response = response_reconciliator(
+    async def reconcile(sample, recommendations, timings):
+        if not cfg.stream_reconciliation:
+            return await response_reconciliator.aforward(
                 patient_question=sample.patient_question,
                 doctor_response=sample.doctor_response,
                 recommendations=recommendations,
             )
-            modified_response_score = scorer.predict(
-                {
-                    "patient_question": sample.patient_question,
-                    "doctor_response": modifier_response,
-                }
+        started_at = time.perf_counter()
+        async for value in response_reconciliator.astream(
+            patient_question=sample.patient_question,
+            doctor_response=sample.doctor_response,
+            recommendations=recommendations,
+        ):
+            if isinstance(value, str):
+                timings.setdefault("first_chunk", time.perf_counter() - started_at)
+            else:
+                return value.modified_response
+
+    async def evaluate_sample(sample):
+        timings = {}
+
+        async def timed(stage, awaitable):
+            started_at = time.perf_counter()
+            result = await awaitable
+            timings[stage] = time.perf_counter() - started_at
+            return result
+
+        base_score = (
+            await timed(
+                "score",
+                scorer.aforward(
+                    patient_question=sample.patient_question,
+                    doctor_response=sample.doctor_response,
+                ),
             )
-            results.append(
-                {
-                    "base_id": sample.base_id,
-                    "patient_question": sample.patient_question,
-                    "doctor_response": sample.doctor_response,
-                    "recommendations": recommendations,
-                    "modified_response": modifier_response,
-                    "base_score": base_score,
-                    "recommendation_score": modified_response_score,
-                }
+        ).toDict()
+        recommendations = await timed(
+            "recommend",
+            recommender.aforward(
+                fields="all",
+                scores=base_score,
+                patient_question=sample.patient_question,
+                doctor_response=sample.doctor_response,
+            ),
+        )
+        modifier_response = await timed(
+            "reconcile", reconcile(sample, recommendations, timings)
+        )
+        modified_response_score = (
+            await timed(
+                "rescore",
+                scorer.aforward(
+                    patient_question=sample.patient_question,
+                    doctor_response=modifier_response,
+                ),
             )
+        ).toDict()
+        for stage, latency in timings.items():
+            stage_latencies[stage].append(latency)
+        return {
+            "recommendations": recommendations,
+            "modified_response": modifier_response,
+            "base_score": base_score,
+            "recommendation_score": modified_response_score,
+            "timings": timings,
+        }
+
+    with mlflow.start_run(run_name=cfg.run_name):
+        # Process each sample
+        print(f"\n\n{'='*50}")
+        print(f"Evaluating recommender")
+        print(f"{'='*50}")
+        # All samples run their chain at once, bounded by the number of in-flight LM calls
+        started_at = time.perf_counter()
+        jsonl_path = await run_resumable(
+            predict_loader, cfg.output_path, evaluate_sample, cfg.batch_concurrency
+        )
+        elapsed = time.perf_counter() - started_at
 
         # Save results
-        Path(cfg.output_path).parent.mkdir(parents=True, exist_ok=True)
-        with open(cfg.output_path, "w") as f:
-            json.dump(results, f)
+        counts = jsonl_to_json(jsonl_path, cfg.output_path, key="base_id")
         mlflow.log_artifact(cfg.output_path)
+        mlflow.log_metric("failed_samples", counts["failed"])
+
+        evaluated = len(stage_latencies["rescore"])
+        if evaluated:
+            throughput = evaluated / elapsed
+            print(f"\n{evaluated} samples in {elapsed:.1f}s, {throughput:.2f} samples/s")
+            print(f"{'stage':<12}{'mean':>10}{'p50':>10}{'p95':>10}")
+            metrics = {"throughput_samples_per_second": throughput}
+            for stage, latencies in stage_latencies.items():
+                mean = sum(latencies) / len(latencies)
+                p50, p95 = percentile(latencies, 50), percentile(latencies, 95)
+                print(f"{stage:<12}{mean:>10.2f}{p50:>10.2f}{p95:>10.2f}")
+                metrics.update(
+                    {
+                        f"{stage}_latency_mean": mean,
+                        f"{stage}_latency_p50": p50,
+                        f"{stage}_latency_p95": p95,
+                    }
+                )
+            mlflow.log_metrics(metrics)
+
+        mlflow.log_metrics(
+            {f"adapter_{name}": count for name, count in adapter_stats.items()}
+        )
+        mlflow.log_metrics(
+            {f"recommendations_{name}": count for name, count in scheduler_stats.items()}
+        )
+        mlflow.log_metrics(
+            {f"reconciliation_{name}": count for name, count in reconciliation_stats.items()}
+        )
+        for key, replicas in balancer_stats().items():
+            # URLs aren't valid metric names, replicas are logged by index
+            for index, (api_base, stats) in enumerate(replicas.items()):
+                mlflow.log_param(f"{key}_replica{index}", api_base)
+                mlflow.log_metrics(
+                    {f"{key}_replica{index}_{name}": value for name, value in stats.items()}
+                )
+        if scorer.store is not None:
+            mlflow.log_metrics(
+                {f"score_store_{name}": value for name, value in scorer.store.stats().items()}
+            )
 
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())
@@ -0,0 +1,77 @@
+import json
+import argparse
+from pathlib import Path
+from models.cascade import fit_thresholds
+from models.prompt_score_v4 import metric_map
+
+
+def field_records(result_dict):
+    """(confidence, correct) pairs per field from the optimized validation outputs of optimize.py."""
+    records = {}
+    for name, unit in result_dict.items():
+        for example, prediction, _ in unit["optimized_results"]:
+            confidences = prediction.get("confidences", {})
+            for field in unit.get("fields", [name]):
+                if confidences.get(field) is None:
+                    continue
+                correct = bool(metric_map[field](example, prediction))
+                records.setdefault(field, []).append((confidences[field], correct))
+    return records
+
+
+def field_accuracies(result_dict):
+    """Validation accuracy per field, as metric_map reports it."""
+    accuracies = {}
+    for name, unit in result_dict.items():
+        fields = unit.get("fields", [name])
+        results = unit["optimized_results"]
+        for field in fields:
+            scores = [metric_map[field](example, prediction) for example, prediction, _ in results]
+            if scores:
+                accuracies[field] = sum(scores) / len(scores)
+    return accuracies
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Fit per-field cascade confidence thresholds from optimize.py outputs"
+    )
+    parser.add_argument(
+        "small_results", help="optimize.py results of the small model, run with logprobs"
+    )
+    parser.add_argument("output_path", help="Where to write the thresholds JSON")
+    parser.add_argument(
+        "--large-results",
+        help="optimize.py results of the large model, its accuracy is the per-field target",
+    )
+    parser.add_argument(
+        "--target",
+        type=float,
+        default=0.9,
+        help="Accuracy target for fields without large model results",
+    )
+    args = parser.parse_args()
+
+    with open(args.small_results) as f:
+        records = field_records(json.load(f))
+    targets = {}
+    if args.large_results:
+        with open(args.large_results) as f:
+            targets = field_accuracies(json.load(f))
+
+    thresholds = fit_thresholds(records, targets, default_target=args.target)
+    for field, threshold in thresholds.items():
+        kept = sum(confidence >= threshold for confidence, _ in records[field])
+        print(
+            f"{field:<22} threshold={threshold:.3f} "
+            f"target={targets.get(field, args.target):.3f} "
+            f"kept={kept}/{len(records[field])}"
+        )
+
+    Path(args.output_path).parent.mkdir(parents=True, exist_ok=True)
+    with open(args.output_path, "w") as f:
+        json.dump(thresholds, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,9 @@
 import dspy
 import asyncio
-import json
 import argparse
 import mlflow
 import logging
-from serde import to_dict
 from importlib import import_module
-from tqdm import tqdm
-from pathlib import Path
 from models.prompt_score_v4 import (
     DoctorResponseScorerModule,
     field_to_evaluator,
@@ -15,7 +11,12 @@ from models.prompt_score_v4 import (
 )
 from models.recommender_v2 import RecommenderModule
 from models.reconciliator import ReconciliatorModule
+from models.adapters import adapter_stats, build_adapter
 from configs.base import Config
+from utils.balancer import balancer_stats
+from utils.concurrency import limiter_stats, run_resumable
+from utils.jsonl import jsonl_to_json
+from utils.lm import shared_lm
 from dataloaders.recommendation_loader import RecommendationLoader
 
 logging.getLogger("LiteLLM").setLevel(logging.CRITICAL)
@@ -36,8 +37,11 @@ async def main():
 
     cfg: Config = import_module(path_to_module(args.config_path)).config
 
-    dspy.settings.configure(lm=dspy.LM(**to_dict(cfg.model_settings)))
+    dspy.settings.configure(
+        lm=shared_lm(cfg.model_settings), adapter=build_adapter(cfg.guided_decoding)
+    )
     scorer = dspy.load(cfg.checkpoint_path)
+    scorer.apply_config(cfg)
     recommender = RecommenderModule(cfg)
     dataloader = RecommendationLoader(cfg)
     predict_loader = dataloader.predict_dataloader()
@@ -47,37 +51,74 @@ async def main():
     mlflow.set_experiment(cfg.experiment_name)
     mlflow.dspy.autolog()
 
-    results = []
-
     with mlflow.start_run(run_name=cfg.run_name):
         # Process each sample
         print(f"\n\n{'='*50}")
         print(f"Evaluating recommender")
         print(f"{'='*50}")
-        for sample in tqdm(predict_loader):
-            base_score = await scorer.aforward(
-                patient_question=sample.patient_question,
-                doctor_response=sample.doctor_response,
-            )
-            recommendations = await recommender.aforward(
-                fields="all",
-                scores=base_score.toDict(),
+
+        async def recommend(sample):
+            # Each recommendation starts as soon as the scores it needs are in,
+            # unless recommendation_priority ranks them once all scores are in
+            deferred = {}
+            base_score, recommendations = await recommender.apipeline(
+                scorer,
                 patient_question=sample.patient_question,
                 doctor_response=sample.doctor_response,
+                deferred=deferred,
             )
-            results.append({
-                "base_id": sample.base_id,
-                "patient_question": sample.patient_question,
-                "doctor_response": sample.doctor_response,
-                "recommendations": recommendations,
-                "base_score": base_score.toDict(),
-            })
-        
+            result = {"recommendations": recommendations, "base_score": base_score}
+            if deferred:
+                # Completed in the background, apart from the ones within budget
+                values = await asyncio.gather(*deferred.values(), return_exceptions=True)
+                result["deferred_recommendations"] = {
+                    field: None if isinstance(value, BaseException) else value
+                    for field, value in zip(deferred, values)
+                }
+            return result
+
+        def show_limits(progress):
+            postfix = {}
+            for key, stats in limiter_stats().items():
+                postfix[f"{key}_limit"] = stats["limit"]
+                postfix[f"{key}_queue"] = stats["queue_depth"]
+            progress.set_postfix(postfix)
+
+        # All samples are scored at once, bounded by the number of in-flight LM calls
+        jsonl_path = await run_resumable(
+            predict_loader, cfg.output_path, recommend, cfg.batch_concurrency, show_limits
+        )
+
         # Save results
-        Path(cfg.output_path).parent.mkdir(parents=True, exist_ok=True)
-        with open(cfg.output_path, 'w') as f:
-            json.dump(results, f)
+        counts = jsonl_to_json(jsonl_path, cfg.output_path, key="base_id")
         mlflow.log_artifact(cfg.output_path)
+        mlflow.log_metric("failed_samples", counts["failed"])
+        mlflow.log_metrics(
+            {f"adapter_{name}": count for name, count in adapter_stats.items()}
+        )
+        for key, replicas in balancer_stats().items():
+            # URLs aren't valid metric names, replicas are logged by index
+            for index, (api_base, stats) in enumerate(replicas.items()):
+                mlflow.log_param(f"{key}_replica{index}", api_base)
+                mlflow.log_metrics(
+                    {f"{key}_replica{index}_{name}": value for name, value in stats.items()}
+                )
+        for key, stats in limiter_stats().items():
+            mlflow.log_metrics(
+                {f"{key}_{name}": value for name, value in stats.items()}
+            )
+        if scorer.store is not None:
+            mlflow.log_metrics(
+                {f"score_store_{name}": value for name, value in scorer.store.stats().items()}
+            )
+        if scorer.prefilter is not None:
+            mlflow.log_metrics(
+                {f"prefilter_skip_rate_{field}": rate for field, rate in scorer.prefilter.skip_rates().items()}
+            )
+        if scorer.cascade_lm is not None:
+            mlflow.log_metrics(
+                {f"cascade_escalation_rate_{field}": rate for field, rate in scorer.escalation_rates().items()}
+            )
 
 
 if __name__ == "__main__":
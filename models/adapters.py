@@ -0,0 +1,130 @@
+import dspy
+import pydantic
+from collections import Counter
+from typing import Any, Type
+from dspy.adapters.base import Adapter
+from dspy.adapters.chat_adapter import ChatAdapter, field_header_pattern
+from dspy.adapters.json_adapter import JSONAdapter
+from dspy.adapters.utils import parse_value
+from litellm import ContextWindowExceededError
+
+# Parse failures, JSON fallbacks and failed LM calls since the process started
+adapter_stats: Counter = Counter()
+
+
+class CountingChatAdapter(ChatAdapter):
+    """ChatAdapter that counts its parse failures and JSONAdapter fallbacks in adapter_stats."""
+
+    def parse(self, signature: Type[dspy.Signature], completion: str) -> dict[str, Any]:
+        try:
+            return super().parse(signature, completion)
+        except Exception:
+            adapter_stats["parse_failures"] += 1
+            raise
+
+    def __call__(self, lm, lm_kwargs, signature, demos, inputs):
+        try:
+            return Adapter.__call__(self, lm, lm_kwargs, signature, demos, inputs)
+        except ContextWindowExceededError:
+            raise
+        except Exception:
+            # Same fallback as ChatAdapter, which sends the request a second time
+            adapter_stats["json_fallbacks"] += 1
+            return JSONAdapter()(lm, lm_kwargs, signature, demos, inputs)
+
+
+def output_schema(signature: Type[dspy.Signature]) -> dict[str, Any]:
+    """JSON schema of the output fields of a signature, e.g. bool or Literal answers."""
+    fields = {
+        name: (field.annotation, ...) for name, field in signature.output_fields.items()
+    }
+    model = pydantic.create_model(
+        f"{signature.__name__}Outputs",
+        __config__=pydantic.ConfigDict(extra="forbid"),
+        **fields,
+    )
+    return model.model_json_schema()
+
+
+class GuidedJSONAdapter(JSONAdapter):
+    """JSONAdapter that constrains the completion to the output schema with vLLM guided decoding.
+
+    The schema goes in the `guided_json` extra body parameter of vLLM's
+    OpenAI-compatible server, so the completion always parses and there is no
+    fallback to retry with.
+    """
+
+    def _call_preprocess(self, lm, lm_kwargs, signature, inputs, use_native_function_calling=True):
+        lm_kwargs["extra_body"] = {
+            **lm_kwargs.get("extra_body", {}),
+            "guided_json": output_schema(signature),
+        }
+        return super()._call_preprocess(
+            lm, lm_kwargs, signature, inputs, use_native_function_calling
+        )
+
+    def __call__(self, lm, lm_kwargs, signature, demos, inputs):
+        return Adapter.__call__(self, lm, lm_kwargs, signature, demos, inputs)
+
+    def parse(self, signature: Type[dspy.Signature], completion: str) -> dict[str, Any]:
+        try:
+            return super().parse(signature, completion)
+        except Exception:
+            adapter_stats["parse_failures"] += 1
+            raise
+
+
+def build_adapter(guided_decoding: bool = False) -> ChatAdapter:
+    """The adapter every predictor uses by default, see Config.guided_decoding."""
+    return GuidedJSONAdapter() if guided_decoding else CountingChatAdapter()
+
+
+class LenientChatAdapter(ChatAdapter):
+    """ChatAdapter that keeps every output field it can parse.
+
+    Fields that are missing or malformed in the completion are returned as None
+    instead of failing the whole prediction, so callers can retry just those.
+    """
+
+    def parse(self, signature: Type[dspy.Signature], completion: str) -> dict[str, Any]:
+        sections = [(None, [])]
+
+        for line in completion.splitlines():
+            match = field_header_pattern.match(line.strip())
+            if match:
+                header = match.group(1)
+                remaining_content = line[match.end() :].strip()
+                sections.append((header, [remaining_content] if remaining_content else []))
+            else:
+                sections[-1][1].append(line)
+
+        fields = {name: None for name in signature.output_fields}
+        for name, lines in sections:
+            if name in fields and fields[name] is None:
+                try:
+                    fields[name] = parse_value(
+                        "\n".join(lines).strip(), signature.output_fields[name].annotation
+                    )
+                except Exception:
+                    pass
+
+        return fields
+
+
+def single_predictor(program: dspy.Module) -> dspy.Predict:
+    (predictor,) = program.predictors()
+    return predictor
+
+
+async def acall_with_adapter(program: dspy.Module, adapter, **kwargs):
+    """Runs a single-predictor program (Predict, ChainOfThought) with a specific adapter.
+
+    dspy.context is thread-local, so switching adapters with it would leak into
+    the other coroutines running on the same event loop.
+    """
+    predictor = single_predictor(program)
+    lm, config, signature, demos, kwargs = predictor._forward_preprocess(**kwargs)
+    completions = await adapter.acall(
+        lm, lm_kwargs=config, signature=signature, demos=demos, inputs=kwargs
+    )
+    return predictor._forward_postprocess(completions, signature, **kwargs)
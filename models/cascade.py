@@ -0,0 +1,115 @@
+import json
+import math
+import re
+from typing import Dict, List, Optional, Tuple
+
+FIELD_HEADER = "[[ ## {field} ## ]]"
+NEXT_HEADER_PATTERN = re.compile(r"\[\[ ## \w+ ## \]\]")
+JSON_DECODER = json.JSONDecoder()
+
+
+def _token_logprobs(logprobs) -> List[Tuple[str, float]]:
+    """(token, logprob) pairs of a completion, from a litellm object or its cached dict."""
+    if logprobs is None:
+        return []
+    content = (
+        logprobs.get("content")
+        if isinstance(logprobs, dict)
+        else getattr(logprobs, "content", None)
+    )
+    pairs = []
+    for item in content or []:
+        if isinstance(item, dict):
+            pairs.append((item["token"], item["logprob"]))
+        else:
+            pairs.append((item.token, item.logprob))
+    return pairs
+
+
+def _chat_value_span(text: str, field: str) -> Optional[Tuple[int, int]]:
+    """Where the value of `field` is in a ChatAdapter completion."""
+    header = FIELD_HEADER.format(field=field)
+    header_at = text.find(header)
+    if header_at < 0:
+        return None
+    start = header_at + len(header)
+    next_header = NEXT_HEADER_PATTERN.search(text, start)
+    return start, next_header.start() if next_header else len(text)
+
+
+def _json_value_span(text: str, field: str) -> Optional[Tuple[int, int]]:
+    """Where the value of `field` is in a JSON completion, e.g. under guided decoding."""
+    key = re.search(rf'"{re.escape(field)}"\s*:\s*', text)
+    if key is None:
+        return None
+    try:
+        _, end = JSON_DECODER.raw_decode(text, key.end())
+    except json.JSONDecodeError:
+        return None
+    start = key.end()
+    if text[start] == '"':
+        # The quotes are forced by the format, not chosen by the model
+        start, end = start + 1, end - 1
+    return start, end
+
+
+def answer_confidence(logprobs, field: str) -> Optional[float]:
+    """Probability the model assigned to the answer it gave for `field`.
+
+    The completion is rebuilt from its tokens and the tokens of the value that
+    follows the field header, or the JSON key, are multiplied together. Returns
+    None when the completion has no logprobs or the field can't be found in it.
+    """
+    tokens = _token_logprobs(logprobs)
+    if not tokens:
+        return None
+
+    text = "".join(token for token, _ in tokens)
+    span = _chat_value_span(text, field) or _json_value_span(text, field)
+    if span is None:
+        return None
+    start, end = span
+
+    # Only the answer itself counts, not the whitespace around it
+    value = text[start:end]
+    start += len(value) - len(value.lstrip())
+    end -= len(value) - len(value.rstrip())
+    if start >= end:
+        return None
+
+    total, offset = 0.0, 0
+    for token, logprob in tokens:
+        if offset < end and offset + len(token) > start:
+            total += logprob
+        offset += len(token)
+    return math.exp(total)
+
+
+def fit_thresholds(
+    records: Dict[str, List[Tuple[float, bool]]],
+    targets: Dict[str, float],
+    default_target: float = 0.9,
+) -> Dict[str, float]:
+    """Fits the lowest confidence threshold per field that keeps the small model accurate enough.
+
+    `records` holds (confidence, correct) pairs of the small model on the
+    validation set. A threshold is accepted when the answers at or above it are
+    at least as accurate as the field target, e.g. the large model accuracy.
+    Fields where no threshold qualifies get an infinite threshold, i.e. they
+    always escalate.
+    """
+    thresholds = {}
+    for field, pairs in records.items():
+        target = targets.get(field, default_target)
+        threshold = math.inf
+        correct = 0
+        pairs = sorted(pairs, key=lambda pair: pair[0], reverse=True)
+        for i, (confidence, is_correct) in enumerate(pairs):
+            correct += is_correct
+            # Thresholds only make sense between distinct confidences
+            if i + 1 < len(pairs) and pairs[i + 1][0] == confidence:
+                continue
+            if correct / (i + 1) >= target:
+                threshold = confidence
+        thresholds[field] = threshold
+    return thresholds
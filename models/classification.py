@@ -0,0 +1,95 @@
+import math
+from typing import Dict, List, Literal, Optional, Tuple, get_args, get_origin
+import dspy
+from dspy.adapters.chat_adapter import ChatAdapter
+from models.adapters import single_predictor
+
+# vLLM's OpenAI-compatible server returns at most 20 alternatives per token
+TOP_LOGPROBS = 20
+
+
+def answer_choices(signature: type[dspy.Signature], field: str) -> Dict[str, object]:
+    """Allowed answers of a bool or Literal output field, as text -> value."""
+    annotation = signature.output_fields[field].annotation
+    if annotation is bool:
+        return {"True": True, "False": False}
+    if get_origin(annotation) is Literal:
+        return {str(choice): choice for choice in get_args(annotation)}
+    raise ValueError(f"{field} is not a bool or Literal field")
+
+
+def _top_logprobs(logprobs) -> List[Tuple[str, float]]:
+    """(token, logprob) alternatives of the first generated token."""
+    content = (
+        logprobs.get("content")
+        if isinstance(logprobs, dict)
+        else getattr(logprobs, "content", None)
+    )
+    if not content:
+        return []
+    first = content[0]
+    alternatives = (
+        first.get("top_logprobs")
+        if isinstance(first, dict)
+        else getattr(first, "top_logprobs", None)
+    )
+    pairs = []
+    for item in alternatives or []:
+        if isinstance(item, dict):
+            pairs.append((item["token"], item["logprob"]))
+        else:
+            pairs.append((item.token, item.logprob))
+    return pairs
+
+
+def choice_probabilities(logprobs, choices: Dict[str, object]) -> Dict[str, float]:
+    """Probabilities of the allowed answers, renormalized over the answers alone.
+
+    Tokens are matched ignoring case and surrounding whitespace, so "true" and
+    " True" both count towards "True". Answers missing from the top logprobs get 0.
+    """
+    by_text = {text.lower(): text for text in choices}
+    mass = {text: 0.0 for text in choices}
+    for token, logprob in _top_logprobs(logprobs):
+        text = by_text.get(token.strip().lower())
+        if text is not None:
+            mass[text] += math.exp(logprob)
+    total = sum(mass.values())
+    if total == 0:
+        return {}
+    return {text: value / total for text, value in mass.items()}
+
+
+async def aclassify(
+    program: dspy.Module,
+    field: str,
+    lm: Optional[dspy.LM] = None,
+    **inputs,
+) -> Tuple[object, Optional[float]]:
+    """Scores a bool or Literal field from the logprobs of a single generated token.
+
+    The prompt is the one ChatAdapter builds for the program, demos included,
+    followed by an assistant turn that already holds the field header, so the
+    next token is the answer. Returns the most likely allowed answer and its
+    probability, or (None, None) when no allowed answer is among the top tokens.
+    """
+    predictor = single_predictor(program)
+    signature = predictor.signature
+    choices = answer_choices(signature, field)
+    lm = lm or predictor.lm or dspy.settings.lm
+
+    messages = ChatAdapter().format(signature, predictor.demos, inputs)
+    messages.append({"role": "assistant", "content": f"[[ ## {field} ## ]]\n"})
+    (output,) = await lm.acall(
+        messages=messages,
+        max_tokens=1,
+        logprobs=True,
+        top_logprobs=TOP_LOGPROBS,
+        extra_body={"continue_final_message": True, "add_generation_prompt": False},
+    )
+
+    probabilities = choice_probabilities(output.get("logprobs"), choices)
+    if not probabilities:
+        return None, None
+    text = max(probabilities, key=probabilities.get)
+    return choices[text], probabilities[text]
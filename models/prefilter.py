@@ -0,0 +1,78 @@
+import re
+from typing import Callable, Dict, List, Optional
+from utils.text import ABBREVIATION_LEXICON
+
+# Units of measure, which may also follow a number directly: "500mg"
+UNIT_LEXICON = ["mg", "mcg", "ml", "g", "kg", "cp", "ui"]
+
+ABBREVIATION_PATTERN = re.compile(
+    r"(?:\b|(?<=\d))(?:"
+    # Acronyms: ECG, TA, ORL, RMN
+    r"[A-ZĂÂÎȘȚ]{2,6}"
+    # Lexicon entries, with or without a trailing period
+    r"|(?i:" + "|".join(ABBREVIATION_LEXICON + UNIT_LEXICON) + r")\.?"
+    # Hyphenated forms of address: d-na, d-nă, d-le, d-ta, d-voastră, d-lui
+    r"|(?i:d-[a-zăâîșț]+)"
+    # Any short word cut with a period and followed by lowercase text: "trat. zilnic"
+    r"|[a-zăâîșț]{1,5}\.(?=\s+[a-zăâîșț])"
+    r")(?=\W|$)"
+)
+
+# Unambiguous punctuation mistakes: a space before punctuation, no space after
+# a comma or a sentence end followed by a word, doubled commas
+PUNCTUATION_ERROR_PATTERN = re.compile(
+    r"\s[,;:!?](?!\S)|[a-zăâîșț],[a-zăâîșțA-ZĂÂÎȘȚ]|[a-zăâîșț][.!?][A-ZĂÂÎȘȚ][a-zăâîșț]|,,"
+)
+
+
+def no_question_asked(patient_question: str, doctor_response: str) -> Optional[bool]:
+    """Without a question mark the doctor can't have asked (clarification) questions."""
+    return False if "?" not in doctor_response else None
+
+
+def no_abbreviations(patient_question: str, doctor_response: str) -> Optional[bool]:
+    return False if ABBREVIATION_PATTERN.search(doctor_response) is None else None
+
+
+def obvious_punctuation_errors(
+    patient_question: str, doctor_response: str
+) -> Optional[bool]:
+    return True if PUNCTUATION_ERROR_PATTERN.search(doctor_response) else None
+
+
+# Deterministic detectors: they return a field value only when they are
+# confident about it, and None to defer to the LM
+detectors: Dict[str, Callable[[str, str], Optional[bool]]] = {
+    "inside_questions": no_question_asked,
+    "clarifications": no_question_asked,
+    "abbreviations": no_abbreviations,
+    "punctuation_errors": obvious_punctuation_errors,
+}
+
+
+class Prefilter:
+    """Cheap first stage of the scorer that decides fields without an LM call when it can."""
+
+    def __init__(self, fields: List[str]):
+        self.detectors = {field: detectors[field] for field in fields if field in detectors}
+        self.checked = {field: 0 for field in self.detectors}
+        self.decided = {field: 0 for field in self.detectors}
+
+    def decide(
+        self, field: str, patient_question: str, doctor_response: str
+    ) -> Optional[bool]:
+        detector = self.detectors.get(field)
+        if detector is None:
+            return None
+
+        value = detector(patient_question, doctor_response)
+        self.checked[field] += 1
+        self.decided[field] += int(value is not None)
+        return value
+
+    def skip_rates(self) -> Dict[str, float]:
+        return {
+            field: self.decided[field] / self.checked[field]
+            for field in self.detectors
+            if self.checked[field]
+        }
@@ -1,7 +1,26 @@
 import asyncio
+import dataclasses
+import json
+import time
 import dspy
 from typing import Dict, List, Literal
 from functools import partial
+from models.adapters import (
+    GuidedJSONAdapter,
+    LenientChatAdapter,
+    acall_with_adapter,
+    adapter_stats,
+    single_predictor,
+)
+from models.cascade import answer_confidence
+from models.classification import aclassify
+from models.prefilter import Prefilter
+from utils.concurrency import lm_slot, run_batch
+from utils.lm import shared_lm
+from configs.base import ScoreStoreSettings
+from utils.score_store import ScoreStore, program_hash
+from utils.threads import parallel_map
+from utils.text import affected_sentences, split_sentences
 
 
 class EmpathyEvaluator(dspy.Signature):
@@ -233,6 +252,22 @@ class OnlineHelpLimitationEvaluator(dspy.Signature):
 class DoctorResponseScorerModule(dspy.Module):
     """Module that orchestrates multiple specialized evaluators for comprehensive assessment."""
 
+    # Class level defaults, so checkpoints pickled before these options existed still load
+    groups: Dict[str, List[str]] = {}
+    fused_scorers: Dict[str, dspy.Module] = {}
+    lazy: bool = False
+    store: ScoreStore | None = None
+    sentence_store: ScoreStore | None = None
+    chunked_fields: List[str] = []
+    prefilter: Prefilter | None = None
+    cascade_lm: dspy.LM | None = None
+    cascade_thresholds: Dict[str, float] = {}
+    default_threshold: float = 0.9
+    cascade_counts: Dict[str, Dict[str, int]] = {}
+    classification: bool = False
+    guided: bool = False
+    workers: int = 1
+
     def __init__(self, cfg):
         super().__init__()
         # Initialize each specialized evaluator
@@ -240,52 +275,463 @@ class DoctorResponseScorerModule(dspy.Module):
         self.scorers = {}
         for field, evaluator in field_to_evaluator.items():
             self.scorers[field] = predict_module(evaluator)
+        self.apply_config(cfg)
+
+    def apply_config(self, cfg):
+        """Applies the runtime scoring options of a config, e.g. to a loaded checkpoint."""
+        # Without scorer_groups, keep the groups a loaded checkpoint was optimized with
+        if cfg.scorer_groups is not None:
+            self.set_groups(cfg.scorer_groups, cfg.predict_module)
+        self.lazy = cfg.lazy_scoring
+        self.store = ScoreStore(cfg.score_store) if cfg.score_store else None
+        self.chunked_fields = [
+            field for field in cfg.chunked_fields or [] if field in local_fields
+        ]
+        # Without a score store, sentence scores are still cached for this process
+        self.sentence_store = (
+            ScoreStore(ScoreStoreSettings(path=":memory:", max_entries=100_000))
+            if self.chunked_fields and self.store is None
+            else None
+        )
+        self.prefilter = Prefilter(cfg.prefilter_fields) if cfg.prefilter_fields else None
+        self.set_cascade(cfg.cascade)
+        self.classification = cfg.classification_scoring
+        self.guided = cfg.guided_decoding
+        self.workers = cfg.sync_workers
+
+    def group_adapter(self):
+        """Adapter of fused calls, guided decoding makes every field parse."""
+        return GuidedJSONAdapter() if self.guided else LenientChatAdapter()
+
+    def set_cascade(self, cascade):
+        """Scores fields with a small model first, escalating answers it is unsure about."""
+        self.cascade_lm = None
+        self.cascade_thresholds = {}
+        self.cascade_counts = {}
+        if cascade is None:
+            return
+        self.cascade_lm = shared_lm(
+            dataclasses.replace(cascade.small_model_settings, logprobs=True)
+        )
+        if cascade.thresholds_path:
+            with open(cascade.thresholds_path) as f:
+                self.cascade_thresholds = json.load(f)
+        self.default_threshold = cascade.default_threshold
+
+    def escalation_rates(self) -> Dict[str, float]:
+        """Fraction of small model answers per field that went to the large model."""
+        return {
+            field: counts["escalated"] / (counts["kept"] + counts["escalated"])
+            for field, counts in self.cascade_counts.items()
+        }
+
+    def prefiltered(self, field, patient_question, doctor_response):
+        """Returns the value of a field when a deterministic detector is confident about it."""
+        if self.prefilter is None:
+            return None
+        return self.prefilter.decide(field, patient_question, doctor_response)
+
+    def lookup(self, field, program, patient_question, doctor_response, store=None):
+        """Returns the store key of a field score and its stored value, if any."""
+        store = store or self.store
+        if store is None:
+            return None, None
+        key = store.key(field, program_hash(program), patient_question, doctor_response)
+        return key, store.get(key)
+
+    def remember(self, key, field, value, store=None):
+        if key is not None and value is not None:
+            (store or self.store).put(key, field, value)
+
+    def set_groups(
+        self,
+        groups: Dict[str, List[str]],
+        predict_module: type[dspy.Module] = dspy.Predict,
+    ):
+        """Scores every group of fields with a single fused LM call.
 
-    async def scorer_async_call(self, scorer, patient_question, doctor_response):
+        Fused predictors that already exist (e.g. loaded from a checkpoint) are kept.
+        """
+        fused_scorers = {}
+        for name, fields in groups.items():
+            if name in self.fused_scorers:
+                fused_scorers[name] = self.fused_scorers[name]
+            else:
+                fused_scorers[name] = predict_module(make_fused_evaluator(fields))
+        self.groups = groups
+        self.fused_scorers = fused_scorers
+
+    async def scorer_async_call(
+        self, scorer, patient_question, doctor_response, adapter=None, lm=None
+    ):
+        # An explicit lm replaces the scorer's own for this call only
+        kwargs = {"lm": lm} if lm is not None else {}
         try:
-            result = await scorer.acall(
-                patient_question=patient_question, doctor_response=doctor_response
-            )
-            return result
+            async with lm_slot(lm or single_predictor(scorer).lm):
+                if adapter is not None:
+                    return await acall_with_adapter(
+                        scorer,
+                        adapter,
+                        patient_question=patient_question,
+                        doctor_response=doctor_response,
+                        **kwargs,
+                    )
+                result = await scorer.acall(
+                    patient_question=patient_question,
+                    doctor_response=doctor_response,
+                    **kwargs,
+                )
+                return result
         except Exception as e:
             print(e)
+            adapter_stats["scorer_errors"] += 1
             return None
 
+    async def small_model_values(
+        self, scorer, fields, patient_question, doctor_response, adapter=None
+    ):
+        """Scores fields with the cascade's small model, keeping only confident answers."""
+        prediction = await self.scorer_async_call(
+            scorer, patient_question, doctor_response, adapter=adapter, lm=self.cascade_lm
+        )
+        logprobs = getattr(prediction, "logprobs", None) if prediction is not None else None
+        values = {}
+        for field in fields:
+            value = getattr(prediction, field, None) if prediction is not None else None
+            if self.is_confident(field, value, answer_confidence(logprobs, field)):
+                values[field] = value
+        return values
+
+    def is_confident(self, field, value, confidence):
+        """Whether a small model answer is kept, otherwise it escalates to the large model."""
+        threshold = self.cascade_thresholds.get(field, self.default_threshold)
+        counts = self.cascade_counts.setdefault(field, {"kept": 0, "escalated": 0})
+        if value is not None and confidence is not None and confidence >= threshold:
+            counts["kept"] += 1
+            return True
+        counts["escalated"] += 1
+        return False
+
+    async def predict_field(self, field, patient_question, doctor_response, lm=None):
+        """Returns the value of a field and its confidence, None when the LM didn't give one."""
+        scorer = self.scorers[field]
+        if self.classification:
+            try:
+                async with lm_slot(lm or single_predictor(scorer).lm):
+                    value, confidence = await aclassify(
+                        scorer,
+                        field,
+                        lm=lm,
+                        patient_question=patient_question,
+                        doctor_response=doctor_response,
+                    )
+            except Exception as e:
+                print(e)
+                adapter_stats["scorer_errors"] += 1
+                value, confidence = None, None
+            if value is not None:
+                return value, confidence
+
+        # Generation is also the fallback when no allowed answer is among the top tokens
+        prediction = await self.scorer_async_call(
+            scorer, patient_question, doctor_response, lm=lm
+        )
+        if prediction is None:
+            return None, None
+        return getattr(prediction, field, None), answer_confidence(
+            getattr(prediction, "logprobs", None), field
+        )
+
+    async def score_field(self, field, patient_question, doctor_response, store=None):
+        value, _ = await self.score_field_with_confidence(
+            field, patient_question, doctor_response, store
+        )
+        return value
+
+    async def score_field_with_confidence(
+        self, field, patient_question, doctor_response, store=None
+    ):
+        """Returns the value of a field and the probability of it, see predict_field.
+
+        Prefiltered values are certain, stored values have no confidence (None).
+        """
+        value = self.prefiltered(field, patient_question, doctor_response)
+        if value is not None:
+            return value, 1.0
+
+        key, value = self.lookup(
+            field, self.scorers[field], patient_question, doctor_response, store
+        )
+        if value is not None:
+            return value, None
+
+        confidence = None
+        if self.cascade_lm is not None:
+            value, confidence = await self.predict_field(
+                field, patient_question, doctor_response, lm=self.cascade_lm
+            )
+            if not self.is_confident(field, value, confidence):
+                value = None
+
+        if value is None:
+            value, confidence = await self.predict_field(
+                field, patient_question, doctor_response
+            )
+        self.remember(key, field, value, store)
+        return value, confidence
+
+    async def score_group(self, name, fields, patient_question, doctor_response):
+        scorer = self.fused_scorers[name]
+        keys, values = {}, {}
+        for field in fields:
+            keys[field], values[field] = None, self.prefiltered(
+                field, patient_question, doctor_response
+            )
+            if values[field] is None:
+                keys[field], values[field] = self.lookup(
+                    field, scorer, patient_question, doctor_response
+                )
+
+        missing = [field for field, value in values.items() if value is None]
+        if missing and self.cascade_lm is not None:
+            small_values = await self.small_model_values(
+                scorer,
+                missing,
+                patient_question,
+                doctor_response,
+                adapter=self.group_adapter(),
+            )
+            for field, value in small_values.items():
+                values[field] = value
+                self.remember(keys[field], field, value)
+
+        if any(value is None for value in values.values()):
+            prediction = await self.scorer_async_call(
+                scorer,
+                patient_question,
+                doctor_response,
+                adapter=self.group_adapter(),
+            )
+            for field in fields:
+                if values[field] is None and prediction is not None:
+                    values[field] = getattr(prediction, field, None)
+                    self.remember(keys[field], field, values[field])
+
+        # Only the fields the fused call could not parse go to their own evaluator
+        failed = [field for field, value in values.items() if value is None]
+        adapter_stats["group_field_fallbacks"] += len(failed)
+        fallback = await asyncio.gather(
+            *[
+                self.score_field(field, patient_question, doctor_response)
+                for field in failed
+            ]
+        )
+        values.update(zip(failed, fallback))
+        return values
+
+    def schedule(self, patient_question, doctor_response, fields):
+        """Starts scoring fields, returns field -> task.
+
+        Every task resolves to a dict of results keyed by field, fields scored
+        together (fused groups) share their task.
+        """
+        tasks = {}
+        for f in fields:
+            if f in self.chunked_fields:
+                tasks[f] = asyncio.ensure_future(
+                    self.score_chunked(f, patient_question, doctor_response)
+                )
+
+        for name, group in self.groups.items():
+            group_fields = [f for f in group if f in fields and f not in tasks]
+            if group_fields:
+                task = asyncio.ensure_future(
+                    self.score_group(
+                        name, group_fields, patient_question, doctor_response
+                    )
+                )
+                tasks.update({f: task for f in group_fields})
+
+        async def value_of(field):
+            return (await tasks[field])[field]
+
+        async def is_needed(field):
+            # Gating fields are awaited first, the field is skipped (None) when
+            # their scores make its recommendation irrelevant
+            for gate, predicate in field_dependencies.get(field, {}).items():
+                if gate in tasks and not predicate(await value_of(gate)):
+                    return False
+            return True
+
+        async def score_if_needed(field):
+            value, confidence = None, None
+            if not self.lazy or await is_needed(field):
+                value, confidence = await self.score_field_with_confidence(
+                    field, patient_question, doctor_response
+                )
+            if self.classification:
+                # The calibrated probability of the answer, like the spans of chunked fields
+                return {field: value, f"{field}_confidence": confidence}
+            return {field: value}
+
+        for f in fields:
+            if f not in tasks:
+                tasks[f] = asyncio.ensure_future(score_if_needed(f))
+
+        return tasks
+
     async def aforward(
         self,
         patient_question: str,
         doctor_response: str,
         fields_to_score: Literal["all"] | List[str] = "all",
     ):
-
-        tasks = []
-        fields = []
         if fields_to_score == "all":
-            for field, scorer in self.scorers.items():
-                tasks.append(
-                    self.scorer_async_call(scorer, patient_question, doctor_response)
+            fields = list(self.scorers.keys())
+        else:
+            fields = list(fields_to_score)
+
+        tasks = self.schedule(patient_question, doctor_response, fields)
+        values = {}
+        for f in fields:
+            values.update(await tasks[f])
+
+        final_result = dspy.Example(**values)
+        return final_result
+
+    async def abatch(
+        self,
+        examples: List[dspy.Example],
+        max_concurrency: int = 32,
+        fields_to_score: Literal["all"] | List[str] = "all",
+    ):
+        """Scores many examples (patient_question, doctor_response) concurrently.
+
+        At most `max_concurrency` LM calls are in flight across the whole batch.
+        Results are in input order, an example that failed has its exception
+        in place of its scores.
+        """
+        return await run_batch(
+            [
+                self.aforward(
+                    example.patient_question, example.doctor_response, fields_to_score
                 )
-                fields.append(field)
+                for example in examples
+            ],
+            max_concurrency,
+        )
+
+    async def astream(
+        self,
+        patient_question: str,
+        doctor_response: str,
+        fields_to_score: Literal["all"] | List[str] = "all",
+    ):
+        """Yields (field, value, latency) as soon as each score is ready.
+
+        Latency is in seconds since the call. Chunked fields also yield their
+        `{field}_spans`, and with classification scoring single fields yield
+        their `{field}_confidence`. Scoring stops when the caller stops iterating.
+        """
+        if fields_to_score == "all":
+            fields = list(self.scorers.keys())
         else:
-            for f in fields_to_score:
-                tasks.append(
-                    self.scorer_async_call(
-                        self.scorers[f],
-                        patient_question,
-                        doctor_response,
-                    )
+            fields = list(fields_to_score)
+
+        started_at = time.perf_counter()
+        tasks = self.schedule(patient_question, doctor_response, fields)
+        unique_tasks = list({id(task): task for task in tasks.values()}.values())
+        try:
+            for next_done in asyncio.as_completed(unique_tasks):
+                values = await next_done
+                latency = time.perf_counter() - started_at
+                for field, value in values.items():
+                    yield field, value, latency
+        finally:
+            for task in unique_tasks:
+                task.cancel()
+
+    async def score_chunked(self, field, patient_question, doctor_response):
+        """Scores a local field sentence by sentence and ORs the sentence scores.
+
+        Sentence scores go through score_field and are cached in the score
+        store, or in memory without one. The sentences scored True are
+        returned as spans.
+        """
+        sentences = split_sentences(doctor_response)
+        if not sentences:
+            value = await self.score_field(field, patient_question, doctor_response)
+            return {field: value, f"{field}_spans": []}
+
+        sentence_values = await asyncio.gather(
+            *[
+                self.score_field(
+                    field,
+                    patient_question,
+                    doctor_response[start:end],
+                    self.store or self.sentence_store,
                 )
-                fields.append(f)
+                for start, end in sentences
+            ]
+        )
+        spans = [
+            span for span, value in zip(sentences, sentence_values) if value == True
+        ]
+        if spans:
+            value = True
+        elif any(value is None for value in sentence_values):
+            value = None
+        else:
+            value = False
+        return {field: value, f"{field}_spans": spans}
 
-        predictions = await asyncio.gather(*tasks)
+    async def arescore(
+        self,
+        patient_question: str,
+        old_response: str,
+        new_response: str,
+        old_scores: Dict,
+        fields_to_score: Literal["all"] | List[str] = "all",
+    ):
+        """Re-scores an edited response, reusing what the edit can't have changed.
 
-        final_result = dspy.Example(
-            **{
-                field: getattr(prediction, field) if prediction is not None else None
-                for field, prediction in zip(fields, predictions)
-            }
+        Local fields that were False on the old response only need to be checked on
+        the sentences the edit touched, every other field is scored again. Chunked
+        fields are scored again too, their unchanged sentences come from the store.
+        """
+        if fields_to_score == "all":
+            fields = list(self.scorers.keys())
+        else:
+            fields = list(fields_to_score)
+
+        if new_response == old_response:
+            return dspy.Example(**{field: old_scores.get(field) for field in fields})
+
+        edited_text = "\n".join(
+            new_response[start:end]
+            for start, end in affected_sentences(old_response, new_response)
+        )
+        incremental = [
+            f
+            for f in fields
+            if f in local_fields
+            and f not in self.chunked_fields
+            and old_scores.get(f) == False
+        ]
+        rescored = [f for f in fields if f not in incremental]
+
+        async def score_edits(field):
+            if not edited_text:
+                return old_scores[field]
+            return await self.score_field(field, patient_question, edited_text)
+
+        rescored_values, *incremental_values = await asyncio.gather(
+            self.aforward(patient_question, new_response, rescored),
+            *[score_edits(f) for f in incremental],
         )
-        return final_result
+
+        values = {**rescored_values.toDict(), **dict(zip(incremental, incremental_values))}
+        return dspy.Example(**values)
 
     def forward(
         self,
@@ -293,20 +739,16 @@ class DoctorResponseScorerModule(dspy.Module):
         doctor_response: str,
         fields: Literal["all"] | List[str] = "all",
     ):
-        result = {}
-
         if fields == "all":
-            for field, scorer in self.scorers.items():
-                value = getattr(
-                    scorer(
-                        patient_question=patient_question,
-                        doctor_response=doctor_response,
-                    ),
-                    field,
+            fields = list(self.scorers.keys())
+
+        def forward_field(f):
+            key, value = None, self.prefiltered(f, patient_question, doctor_response)
+            if value is None:
+                key, value = self.lookup(
+                    f, self.scorers[f], patient_question, doctor_response
                 )
-                result[field] = value
-        else:
-            for f in fields:
+            if value is None:
                 value = getattr(
                     self.scorers[f](
                         patient_question=patient_question,
@@ -314,9 +756,12 @@ class DoctorResponseScorerModule(dspy.Module):
                     ),
                     f,
                 )
-                result[f] = value
+                self.remember(key, f, value)
+            return value
 
-        return dspy.Example(**result)
+        # Evaluators are independent, they run on the shared thread pool
+        values = parallel_map(forward_field, fields, self.workers)
+        return dspy.Example(**dict(zip(fields, values)))
 
 
 def numeric_metric(
@@ -343,6 +788,15 @@ def boolean_metric(
     return 0.0
 
 
+def group_metric(
+    gold: Dict, prediction: Dict, trace=None, fields: List[str] = None
+) -> float:
+    """Averages the per-field metrics of a group of fields scored together."""
+    return sum(metric_map[field](gold, prediction, trace) for field in fields) / len(
+        fields
+    )
+
+
 # Module-specific metrics map for use during evaluation
 metric_map = {
     "empathy": partial(numeric_metric, field_name="empathy"),
@@ -508,6 +962,60 @@ field_to_evaluator = {
     "cannot_help_online": OnlineHelpLimitationEvaluator,
 }
 
+# Clusters of related axes that can be scored (and optimized) as a single unit
+evaluator_groups: Dict[str, List[str]] = {
+    "orthography": ["grammatical_errors", "abbreviations", "punctuation_errors"],
+    "explanation": [
+        "explanation_causes",
+        "explanation_symptoms",
+        "explanation_treatment",
+        "explanation_risk_factors",
+        "explanation_next_steps",
+    ],
+    "referral": ["other_specialty", "only_recommends_visit", "cannot_help_online"],
+}
+
+# Fields that hold for a response iff they hold for one of its sentences, so an
+# edit can only change them through the sentences it touched
+local_fields = ["grammatical_errors", "abbreviations", "punctuation_errors"]
+
+
+def _is_false(value):
+    return value == False
+
+
+# Field -> {gating field: predicate on the gating score}. With lazy scoring a
+# field is only evaluated when every predicate holds. A gate must never change
+# a recommendation: treatment_should_offer is only read by the recommendation
+# of treatment_did_offer, which needs the treatment not to have been offered.
+# Skipped fields are None. Fields scored in a fused group (scorer_groups) share
+# the group's single call, so they are never skipped.
+field_dependencies = {
+    "treatment_should_offer": {"treatment_did_offer": _is_false},
+}
+
+
+def make_fused_evaluator(fields: List[str]) -> type[dspy.Signature]:
+    """Builds a signature that scores several fields of the same response in a single call."""
+    evaluators = [field_to_evaluator[field] for field in fields]
+    signature_fields = dict(evaluators[0].input_fields)
+    for field, evaluator in zip(fields, evaluators):
+        signature_fields[field] = evaluator.output_fields[field]
+
+    instructions = "Evaluates multiple aspects of a doctor's response:\n" + "\n".join(
+        f"- {field}: {evaluator.instructions}"
+        for field, evaluator in zip(fields, evaluators)
+    )
+    return dspy.make_signature(
+        signature_fields, instructions, signature_name="FusedEvaluator"
+    )
+
+
+# Other fields check_for_needed_recommendation reads for a field
+recommendation_dependencies = {
+    "treatment_did_offer": ["treatment_should_offer"],
+}
+
 
 def check_for_needed_recommendation(field, row):
     if field == "empathy":
@@ -524,7 +1032,7 @@ def check_for_needed_recommendation(field, row):
     if (
         field == "treatment_did_offer"
         and row[field] == False
-        and row["treatment_should_offer"] == True
+        and row.get("treatment_should_offer") == True
     ):
         return True
 
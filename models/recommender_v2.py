@@ -1,10 +1,16 @@
 import asyncio
 import dspy
-from typing import List, Literal
+from collections import Counter
+from typing import Dict, List, Literal, Optional
 from models.prompt_score_v4 import (
     description_map,
     check_for_needed_recommendation,
+    recommendation_dependencies,
 )
+from models.adapters import adapter_stats
+from utils.concurrency import lm_slot, run_batch
+from utils.lm import shared_lm
+from utils.threads import parallel_map
 
 
 class EmpathyRecommender(dspy.Signature):
@@ -303,6 +309,142 @@ field_to_recommender = {
 }
 
 
+class SlotExtractor(dspy.Signature):
+    """Extrage din conversație informațiile necesare completării recomandărilor.
+    Răspunde doar cu termenii ceruți, în limba română, fără alte explicații.
+    """
+
+    patient_question = dspy.InputField(desc="Întrebarea pacientului")
+    doctor_response = dspy.InputField(desc="Răspunsul doctorului")
+    condition: str = dspy.OutputField(
+        desc="Afecțiunea discutată, cu articol hotărât, de ex. \"durerile de cap\""
+    )
+    condition_genitive: str = dspy.OutputField(
+        desc="Aceeași afecțiune, la genitiv, de ex. \"durerilor de cap\""
+    )
+    medications: str = dspy.OutputField(
+        desc="Medicamentele menționate, separate prin virgulă, sau gol dacă nu există"
+    )
+
+
+# Recommenders told to output a fixed sentence, produced locally instead. Slots
+# ({condition}, {condition_genitive}, {medications}) come from one SlotExtractor call per response
+recommendation_templates = {
+    "other_specialty": "În cazul în care considerați că întrebarea adresată ține de o altă specialitate medicală, vă rugăm să o refuzați, conform procedurii.",
+    "only_recommends_visit": "În cazul în care considerați că întrebarea adresată nu se pretează unui consult online, fiind necesară o consultație fizică, vă rugăm să o refuzați, conform procedurii.",
+    "cannot_help_online": "În cazul în care considerați că nu puteți ajuta în mediul online, vă rugăm să refuzați conversația, conform procedurii.",
+    "explanation_risk_factors": "Răspunsul ar putea beneficia de informații legate de factorii de risc.",
+    "explanation_next_steps": "Răspunsul ar putea beneficia de includerea unor informații privind pașii următori.",
+    "explanation_causes": "Răspunsul ar putea beneficia de o detaliere a posibilelor cauze ale {condition_genitive}.",
+    "explanation_symptoms": "Răspunsul ar putea beneficia de o detaliere a simptomelor frecvent asociate cu {condition}.",
+    "prescription_should_offer": "În cazul în care medicamentul/medicamentele {medications} necesită rețetă, o puteți atașa.",
+}
+
+
+def fill_template(template: str, slots: dict):
+    """The filled template, or None when a slot it needs wasn't extracted."""
+    try:
+        return template.format_map(
+            {name: value for name, value in slots.items() if value and value.strip()}
+        )
+    except KeyError:
+        return None
+
+
+class FusedRecommender(dspy.Signature):
+    """Creează recomandări pentru toate aspectele semnalate ale răspunsului medicului, într-un singur răspuns.
+    Pentru fiecare aspect urmează îndrumările lui și ține cont de scorul obținut.
+    Recomandările trebuie să fie în limba română si sa fie succinte.
+    Nu oferi recomandări medicale, nu ii spune doctorului ce sa faca, doar semnaleaza posibile probleme din raspunsul lui.
+    """
+
+    patient_question = dspy.InputField(desc="Întrebarea pacientului")
+    doctor_response = dspy.InputField(desc="Răspunsul doctorului, care va fi evaluat")
+    flagged = dspy.InputField(
+        desc="Aspectele semnalate, fiecare cu ce măsoară, scorul obținut și îndrumările recomandării"
+    )
+    recommendations: Dict[str, str] = dspy.OutputField(
+        desc="Recomandarea pentru fiecare aspect semnalat, după numele aspectului"
+    )
+
+
+def describe_flagged(fields: List[str], scores: dict, doctor_response: str) -> str:
+    """The flagged fields as FusedRecommender reads them, with their own recommender's instructions."""
+    sections = []
+    for field in fields:
+        lines = [
+            f"## {field}",
+            f"Ce măsoară: {description_map[field]}",
+            f"Scor: {scores[field]}",
+            f"Îndrumări: {field_to_recommender[field].instructions}",
+        ]
+        spans = scores.get(f"{field}_spans")
+        if spans:
+            lines.append(
+                "Fragmente: " + " | ".join(doctor_response[start:end] for start, end in spans)
+            )
+        sections.append("\n".join(lines))
+    return "\n\n".join(sections)
+
+
+def fused_values(prediction, fields: List[str]) -> dict:
+    """Recommendations of a FusedRecommender prediction, only the fields it answered."""
+    recommendations = getattr(prediction, "recommendations", None) or {}
+    return {
+        field: recommendations[field]
+        for field in fields
+        if isinstance(recommendations.get(field), str) and recommendations[field].strip()
+    }
+
+
+# How much a recommendation on each field matters to the doctor, see Config.recommendation_priority
+priority_weights = {
+    "problems_addressed": 3.0,
+    "other_specialty": 2.5,
+    "only_recommends_visit": 2.5,
+    "cannot_help_online": 2.5,
+    "treatment_did_offer": 2.5,
+    "empathy": 2.0,
+    "clarifications": 2.0,
+    "explanation_causes": 1.5,
+    "explanation_symptoms": 1.5,
+    "explanation_risk_factors": 1.5,
+    "explanation_next_steps": 1.5,
+    "prescription_should_offer": 1.5,
+    "inside_questions": 1.0,
+    "generated_with_chatgpt": 1.0,
+    "grammatical_errors": 0.5,
+    "abbreviations": 0.5,
+    "punctuation_errors": 0.25,
+}
+
+# Recommendations dropped or deferred by the priority scheduler since the process started
+scheduler_stats: Counter = Counter()
+
+
+def severity(field: str, scores: dict) -> float:
+    """How far a flagged field is from needing no recommendation, 1 for flags."""
+    # Scales where 1 is the worst: empathy goes up to 4, problems_addressed to 5
+    if field == "empathy":
+        return (4 - int(scores[field])) / 3
+    if field == "problems_addressed":
+        return (5 - int(scores[field])) / 4
+    return 1.0
+
+
+def rank_fields(fields: List[str], scores: dict, weights: Dict[str, float]) -> List[str]:
+    """Flagged fields by impact weight times severity, highest first, ties in their given order."""
+    return sorted(
+        fields,
+        key=lambda field: weights.get(field, 1.0) * severity(field, scores),
+        reverse=True,
+    )
+
+
+async def pick(task: asyncio.Future, field: str):
+    return (await task)[field]
+
+
 class RecommenderModule(dspy.Module):
 
     def __init__(self, cfg):
@@ -310,6 +452,174 @@ class RecommenderModule(dspy.Module):
         self.recommenders = {}
         for field, signature in field_to_recommender.items():
             self.recommenders[field] = dspy.Predict(signature)
+        self.slot_extractor = dspy.Predict(SlotExtractor)
+        self.fused_recommender = dspy.Predict(FusedRecommender)
+        self.workers = cfg.sync_workers
+        self.templates = cfg.recommendation_templates
+        self.fused = cfg.fused_recommendations
+        self.priority = cfg.recommendation_priority
+        self.weights = {**priority_weights, **((self.priority and self.priority.weights) or {})}
+        # Recommendations can run on their own endpoint, with their own concurrency budget
+        if cfg.recommender_settings is not None:
+            self.set_lm(shared_lm(cfg.recommender_settings))
+
+    def slot_extraction(self, patient_question: str, doctor_response: str, lm=None):
+        """Returns a function giving the task of a single SlotExtractor call, started on first use."""
+        task = None
+
+        async def extract():
+            lm_ = lm or self.slot_extractor.lm
+            async with lm_slot(lm_):
+                result = await self.slot_extractor.aforward(
+                    patient_question=patient_question,
+                    doctor_response=doctor_response,
+                    lm=lm_,
+                )
+            return result.toDict()
+
+        def slots():
+            nonlocal task
+            if task is None:
+                task = asyncio.ensure_future(extract())
+            return task
+
+        return slots
+
+    async def recommend_field(
+        self,
+        field: str,
+        scores: dict,
+        patient_question: str,
+        doctor_response: str,
+        lm=None,
+        slots=None,
+    ):
+        if self.templates and field in recommendation_templates:
+            template = recommendation_templates[field]
+            if "{" not in template:
+                return template
+            slots = slots or self.slot_extraction(patient_question, doctor_response, lm)
+            try:
+                recommendation = fill_template(template, await slots())
+            except Exception as e:
+                print(e)
+                recommendation = None
+            # Without the slot value, the recommender writes the sentence itself
+            if recommendation is not None:
+                return recommendation
+
+        recommender = self.recommenders[field]
+        lm = lm or recommender.lm
+
+        # Chunked scores point at the offending sentences, no need for the whole text
+        spans = scores.get(f"{field}_spans")
+        if spans:
+            doctor_response = "\n".join(
+                doctor_response[start:end] for start, end in spans
+            )
+
+        async with lm_slot(lm):
+            result = await recommender.aforward(
+                patient_question=patient_question,
+                doctor_response=doctor_response,
+                score=scores[field],
+                lm=lm,
+            )
+        return result.recommendation
+
+    def templated(self, field: str) -> bool:
+        return self.templates and field in recommendation_templates
+
+    async def recommend_fused(
+        self,
+        fields: List[str],
+        scores: dict,
+        patient_question: str,
+        doctor_response: str,
+        lm=None,
+    ) -> dict:
+        """Recommends on every field with one FusedRecommender call.
+
+        Fields the fused call leaves out or can't parse go to their own recommender.
+        """
+        results = {}
+        lm_ = lm or self.fused_recommender.lm
+        try:
+            async with lm_slot(lm_):
+                prediction = await self.fused_recommender.aforward(
+                    patient_question=patient_question,
+                    doctor_response=doctor_response,
+                    flagged=describe_flagged(fields, scores, doctor_response),
+                    lm=lm_,
+                )
+            results = fused_values(prediction, fields)
+        except Exception as e:
+            print(e)
+        adapter_stats["recommendation_fallbacks"] += len(fields) - len(results)
+
+        remaining = [f for f in fields if f not in results]
+        values = await asyncio.gather(
+            *[
+                self.recommend_field(f, scores, patient_question, doctor_response, lm=lm)
+                for f in remaining
+            ]
+        )
+        results.update(zip(remaining, values))
+        return results
+
+    def start_recommendations(
+        self,
+        fields: List[str],
+        scores: dict,
+        patient_question: str,
+        doctor_response: str,
+        lm=None,
+        slots=None,
+    ) -> Dict[str, asyncio.Future]:
+        """Starts recommending on fields, returns field -> task.
+
+        With fused recommendations, the fields the LM writes share one call.
+        """
+        fused = [f for f in fields if not self.templated(f)] if self.fused else []
+        tasks = {}
+        if len(fused) > 1:
+            shared = asyncio.ensure_future(
+                self.recommend_fused(fused, scores, patient_question, doctor_response, lm=lm)
+            )
+            for field in fused:
+                tasks[field] = asyncio.ensure_future(pick(shared, field))
+        for field in fields:
+            if field not in tasks:
+                tasks[field] = asyncio.ensure_future(
+                    self.recommend_field(
+                        field, scores, patient_question, doctor_response, lm=lm, slots=slots
+                    )
+                )
+        return tasks
+
+    async def recommend_fields(
+        self,
+        fields: List[str],
+        scores: dict,
+        patient_question: str,
+        doctor_response: str,
+        lm=None,
+        slots=None,
+    ) -> dict:
+        tasks = self.start_recommendations(
+            fields, scores, patient_question, doctor_response, lm=lm, slots=slots
+        )
+        values = await asyncio.gather(*tasks.values())
+        return dict(zip(tasks, values))
+
+    def prioritize(self, fields: List[str], scores: dict, limit: Optional[int] = None):
+        """Splits flagged fields into the top `limit` by priority and the rest."""
+        if limit is None and self.priority is not None:
+            limit = self.priority.max_recommendations
+        if limit is None:
+            return fields, []
+        ranked = rank_fields(fields, scores, self.weights)
+        return ranked[:limit], ranked[limit:]
 
     async def aforward(
         self,
@@ -317,60 +627,175 @@ class RecommenderModule(dspy.Module):
         patient_question: str,
         doctor_response: str,
         fields: Literal["all"] | List[str] = "all",
-        max_tasks: int = 3,
+        max_tasks: Optional[int] = None,
         lm=None,
+        deferred: Optional[Dict[str, asyncio.Future]] = None,
     ):
+        """Recommends on the flagged fields, the most important ones first.
+
+        At most `max_tasks` fields are recommended on, picked by priority
+        (rank_fields). It defaults to Config.recommendation_priority's
+        max_recommendations, or 3 for an explicit list of fields. Recommendations
+        still running after the latency budget are cancelled, or with background
+        completion keep running; they and the fields beyond `max_tasks` are then
+        put in `deferred` as field -> task, when given.
+        """
+        slots = self.slot_extraction(patient_question, doctor_response, lm)
 
         if fields == "all":
-            tasks = []
-            fields_to_process = []
-
-            for field_name, instance in self.recommenders.items():
-                if field_name in scores and check_for_needed_recommendation(
-                    field_name, scores
-                ):
-                    tasks.append(
-                        instance.aforward(
-                            patient_question=patient_question,
-                            doctor_response=doctor_response,
-                            score=scores[field_name],
-                            lm=lm,
-                        )
-                    )
-                    fields_to_process.append(field_name)
-
-            results_list = await asyncio.gather(*tasks) if tasks else []
-
-            results = {field_name: None for field_name in self.recommenders.keys()}
-            for field_name, result in zip(fields_to_process, results_list):
-                results[field_name] = result.recommendation
-
-            return results
-
-        # For single field case
-        tasks = []
-        fields_to_process = []
-        for f in fields:
-            if f in self.recommenders and check_for_needed_recommendation(f, scores):
-                tasks.append(
-                    self.recommenders[f].aforward(
-                        patient_question=patient_question,
-                        doctor_response=doctor_response,
-                        score=scores[f],
-                        lm=lm,
-                    )
+            fields = list(self.recommenders.keys())
+        elif max_tasks is None and self.priority is None:
+            max_tasks = 3
+        needed = [
+            f
+            for f in fields
+            if f in self.recommenders
+            and f in scores
+            and check_for_needed_recommendation(f, scores)
+        ]
+        selected, rest = self.prioritize(needed, scores, max_tasks)
+
+        tasks = self.start_recommendations(
+            selected, scores, patient_question, doctor_response, lm=lm, slots=slots
+        )
+        budget = self.priority.latency_budget if self.priority is not None else None
+        if tasks:
+            await asyncio.wait(tasks.values(), timeout=budget)
+
+        background = (
+            deferred is not None
+            and self.priority is not None
+            and self.priority.background
+        )
+        results = {field_name: None for field_name in self.recommenders.keys()}
+        for field, task in tasks.items():
+            if task.done():
+                results[field] = task.result()
+                continue
+            scheduler_stats["over_budget"] += 1
+            if background:
+                deferred[field] = task
+            else:
+                task.cancel()
+
+        scheduler_stats["deferred"] += len(rest)
+        if background and rest:
+            # Deferred fields wait for the prioritized ones, not to compete with them
+            async def later():
+                await asyncio.gather(*tasks.values(), return_exceptions=True)
+                return await self.recommend_fields(
+                    rest, scores, patient_question, doctor_response, lm=lm, slots=slots
+                )
+
+            shared = asyncio.ensure_future(later())
+            for field in rest:
+                deferred[field] = asyncio.ensure_future(pick(shared, field))
+
+        return results
+
+    async def abatch(
+        self,
+        examples: List[dspy.Example],
+        scores: List[dict],
+        max_concurrency: int = 32,
+        fields: Literal["all"] | List[str] = "all",
+    ):
+        """Recommends on many scored examples concurrently, see DoctorResponseScorerModule.abatch."""
+        return await run_batch(
+            [
+                self.aforward(
+                    example_scores,
+                    example.patient_question,
+                    example.doctor_response,
+                    fields=fields,
                 )
-                fields_to_process.append(f)
-            if len(tasks) >= max_tasks:
-                break
+                for example, example_scores in zip(examples, scores)
+            ],
+            max_concurrency,
+        )
+
+    async def apipeline(
+        self,
+        scorer,
+        patient_question: str,
+        doctor_response: str,
+        fields: Literal["all"] | List[str] = "all",
+        lm=None,
+        deferred: Optional[Dict[str, asyncio.Future]] = None,
+    ):
+        """Scores a response and recommends on each field as soon as its scores are in.
+
+        A field's recommendation starts once the field and every field its check
+        reads (recommendation_dependencies) are scored, instead of after all
+        scores. With fused recommendations, the fields the LM writes wait for
+        every score and go in a single call. With Config.recommendation_priority
+        the scheduler of aforward ranks every flagged field, so recommendations
+        wait for all the scores and `deferred` is filled as in aforward.
+        Returns the scores and the recommendations, like scorer.aforward followed
+        by aforward.
+        """
+        if self.priority is not None:
+            scores = (
+                await scorer.aforward(patient_question, doctor_response, fields)
+            ).toDict()
+            recommendations = await self.aforward(
+                scores, patient_question, doctor_response, lm=lm, deferred=deferred
+            )
+            return scores, recommendations
+
+        if fields == "all":
+            fields = list(scorer.scorers.keys())
+        scored = set(fields)
+
+        def inputs_of(field):
+            needed = [field] + recommendation_dependencies.get(field, [])
+            if field in scorer.chunked_fields:
+                needed.append(f"{field}_spans")
+            return [f for f in needed if f.removesuffix("_spans") in scored]
+
+        scores = {}
+        tasks = {}
+        fused = []
+        waiting = [f for f in self.recommenders if f in scored]
+        slots = self.slot_extraction(patient_question, doctor_response, lm)
+
+        def launch_ready():
+            for field in list(waiting):
+                if all(f in scores for f in inputs_of(field)):
+                    waiting.remove(field)
+                    if not check_for_needed_recommendation(field, scores):
+                        continue
+                    if self.fused and not self.templated(field):
+                        fused.append(field)
+                    else:
+                        tasks[field] = asyncio.ensure_future(
+                            self.recommend_field(
+                                field,
+                                scores,
+                                patient_question,
+                                doctor_response,
+                                lm=lm,
+                                slots=slots,
+                            )
+                        )
 
-        results_list = await asyncio.gather(*tasks) if tasks else []
+        async for field, value, _ in scorer.astream(
+            patient_question, doctor_response, fields
+        ):
+            scores[field] = value
+            launch_ready()
 
         results = {field: None for field in self.recommenders.keys()}
-        for field_name, result in zip(fields_to_process, results_list):
-            results[field_name] = result.recommendation
+        if fused:
+            results.update(
+                await self.recommend_fields(
+                    fused, scores, patient_question, doctor_response, lm=lm, slots=slots
+                )
+            )
+        for field, task in tasks.items():
+            results[field] = await task
 
-        return results
+        return scores, results
 
     def forward(
         self,
@@ -380,27 +805,53 @@ class RecommenderModule(dspy.Module):
         fields: Literal["all"] | List[str] = "all",
     ):
         if fields == "all":
-            results = {}
-            for field, instance in self.recommenders.items():
-                if check_for_needed_recommendation(fields, scores):
-                    results[field] = instance(
-                        patient_question=patient_question,
-                        doctor_response=doctor_response,
-                        score=scores[field],
-                    ).recommendation
-                else:
-                    results[field] = None
-            return results
-
-        for f in fields:
-            results = {}
-            if f in self.recommenders and check_for_needed_recommendation(f, scores):
-                results[f] = self.recommenders[f](
+            fields = list(self.recommenders.keys())
+
+        needed = [
+            f
+            for f in fields
+            if f in self.recommenders
+            and f in scores
+            and check_for_needed_recommendation(f, scores)
+        ]
+        needed, rest = self.prioritize(needed, scores)
+        scheduler_stats["deferred"] += len(rest)
+
+        slots = {}
+        if self.templates and any(
+            "{" in recommendation_templates.get(f, "") for f in needed
+        ):
+            slots = self.slot_extractor(
+                patient_question=patient_question, doctor_response=doctor_response
+            ).toDict()
+
+        results = {f: None for f in fields}
+        fused = [f for f in needed if not self.templated(f)] if self.fused else []
+        if len(fused) > 1:
+            try:
+                prediction = self.fused_recommender(
                     patient_question=patient_question,
                     doctor_response=doctor_response,
-                    score=scores[f],
-                ).recommendation
-            else:
-                results[f] = None
-            return results
-        return {}
+                    flagged=describe_flagged(fused, scores, doctor_response),
+                )
+                results.update(fused_values(prediction, fused))
+            except Exception as e:
+                print(e)
+            adapter_stats["recommendation_fallbacks"] += sum(
+                results[f] is None for f in fused
+            )
+
+        def recommend(f):
+            if self.templated(f):
+                recommendation = fill_template(recommendation_templates[f], slots)
+                if recommendation is not None:
+                    return recommendation
+            return self.recommenders[f](
+                patient_question=patient_question,
+                doctor_response=doctor_response,
+                score=scores[f],
+            ).recommendation
+
+        remaining = [f for f in needed if results[f] is None]
+        results.update(zip(remaining, parallel_map(recommend, remaining, self.workers)))
+        return results
@@ -1,5 +1,16 @@
+import asyncio
 import dspy
+import pydantic
+from collections import Counter
+from typing import List
+from dspy.streaming import StreamListener, StreamResponse
 from configs.base import Config
+from utils.concurrency import lm_slot
+from utils.lm import shared_lm
+from utils.text import apply_edits
+
+# Patched responses and fallbacks to a full rewrite since the process started
+reconciliation_stats: Counter = Counter()
 
 
 class ReconciliatorSignature(dspy.Signature):
@@ -16,26 +27,181 @@ class ReconciliatorSignature(dspy.Signature):
     )
 
 
+class TextEdit(pydantic.BaseModel):
+    original: str = pydantic.Field(
+        description="Fragmentul din răspunsul doctorului, citat exact"
+    )
+    replacement: str = pydantic.Field(description="Textul care înlocuiește fragmentul")
+
+
+class PatchReconciliatorSignature(dspy.Signature):
+    """Improves the doctor's response using the provided recommendations, as a list of edits.
+    Each edit quotes exactly a short fragment of the response and gives the text replacing it.
+    To add text, quote the fragment it follows and repeat it at the start of the replacement.
+    Fragments that don't change are left out of the edits.
+    """
+
+    patient_question = dspy.InputField(desc="Întrebarea pacientului")
+    doctor_response = dspy.InputField(desc="Răspunsul doctorului, care va fi evaluat")
+    recommendations = dspy.InputField(
+        desc=f"Recomandări pentru a îmbunătăți răspunsul doctorului"
+    )
+
+    edits: List[TextEdit] = dspy.OutputField(
+        desc=f"Modificările aduse răspunsului doctorului folosind recomandările"
+    )
+
+
+def patched_response(doctor_response: str, recommendations: dict, prediction) -> str | None:
+    """The response with the predicted edits applied, None when they don't apply cleanly."""
+    edits = [(edit.original, edit.replacement) for edit in prediction.edits or []]
+    # No edits at all would silently drop the recommendations
+    if not edits and any(recommendations.values()):
+        return None
+    return apply_edits(doctor_response, edits)
+
+
 class ReconciliatorModule(dspy.Module):
 
     def __init__(self, cfg: Config):
         super().__init__()
         self.reconciliator = dspy.Predict(ReconciliatorSignature)
+        self.patcher = dspy.Predict(PatchReconciliatorSignature)
+        self.patching = cfg.patch_reconciliation
+        # Shares the recommender's endpoint and concurrency budget
+        if cfg.recommender_settings is not None:
+            self.set_lm(shared_lm(cfg.recommender_settings))
         
+    async def apatch(
+        self, patient_question: str, doctor_response: str, recommendations: dict, lm=None
+    ):
+        """The response patched with predicted edits, None when a full rewrite is needed."""
+        try:
+            async with lm_slot(lm):
+                prediction = await self.patcher.aforward(
+                    patient_question=patient_question,
+                    doctor_response=doctor_response,
+                    recommendations=recommendations,
+                    lm=lm,
+                )
+        except Exception as e:
+            prediction = e
+        return self.patch_outcome(doctor_response, recommendations, prediction)
+
+    def patch(self, patient_question: str, doctor_response: str, recommendations: dict):
+        """Sync apatch."""
+        try:
+            prediction = self.patcher(
+                patient_question=patient_question,
+                doctor_response=doctor_response,
+                recommendations=recommendations,
+            )
+        except Exception as e:
+            prediction = e
+        return self.patch_outcome(doctor_response, recommendations, prediction)
+
+    def patch_outcome(self, doctor_response: str, recommendations: dict, prediction):
+        """Applies a patcher prediction, or the error of its call, counting it in reconciliation_stats."""
+        modified_response = None
+        try:
+            if isinstance(prediction, Exception):
+                raise prediction
+            modified_response = patched_response(doctor_response, recommendations, prediction)
+        except Exception as e:
+            print(e)
+        reconciliation_stats["patched" if modified_response is not None else "rewrites"] += 1
+        return modified_response
+
     async def aforward(
         self, patient_question: str, doctor_response: str, recommendations: dict, lm=None
     ):
-        output = await self.reconciliator.aforward(
-            patient_question=patient_question,
-            doctor_response=doctor_response,
-            recommendations=recommendations,
-            lm=lm
-        )
+        lm = lm or self.reconciliator.lm
+        if self.patching:
+            modified_response = await self.apatch(
+                patient_question, doctor_response, recommendations, lm=lm
+            )
+            if modified_response is not None:
+                return modified_response
+
+        async with lm_slot(lm):
+            output = await self.reconciliator.aforward(
+                patient_question=patient_question,
+                doctor_response=doctor_response,
+                recommendations=recommendations,
+                lm=lm
+            )
         return output.modified_response
 
+    async def astream(
+        self, patient_question: str, doctor_response: str, recommendations: dict, lm=None
+    ):
+        """Yields the modified_response in chunks as the LM generates it, then the final dspy.Prediction.
+
+        Closing the generator, or cancelling the task iterating it, stops reading
+        the LM call and frees its concurrency slot. dspy doesn't close the
+        underlying litellm stream, so the server only notices once litellm drops
+        the connection. Cached and patched responses come as a single chunk.
+        """
+        lm = lm or self.reconciliator.lm
+        if self.patching:
+            modified_response = await self.apatch(
+                patient_question, doctor_response, recommendations, lm=lm
+            )
+            if modified_response is not None:
+                yield modified_response
+                yield dspy.Prediction(modified_response=modified_response)
+                return
+
+        # Listeners keep the state of one stream, every call gets its own
+        stream = dspy.streamify(
+            self.reconciliator,
+            stream_listeners=[StreamListener(signature_field_name="modified_response")],
+            include_final_prediction_in_output_stream=True,
+            is_async_program=True,
+        )
+        # dspy's stream can't be closed half way, it is read from a task that is cancelled instead
+        values = asyncio.Queue()
+
+        async def read():
+            try:
+                async with lm_slot(lm):
+                    async for value in stream(
+                        patient_question=patient_question,
+                        doctor_response=doctor_response,
+                        recommendations=recommendations,
+                        lm=lm,
+                    ):
+                        await values.put(value)
+            except Exception as e:
+                await values.put(e)
+            await values.put(None)
+
+        reader = asyncio.ensure_future(read())
+        streamed = False
+        try:
+            while (value := await values.get()) is not None:
+                if isinstance(value, Exception):
+                    raise value
+                if isinstance(value, StreamResponse):
+                    streamed = True
+                    yield value.chunk
+                elif isinstance(value, dspy.Prediction):
+                    if not streamed:
+                        yield value.modified_response
+                    yield value
+        finally:
+            reader.cancel()
+
     def forward(
         self, patient_question: str, doctor_response: str, recommendations: dict
     ):
+        if self.patching:
+            modified_response = self.patch(
+                patient_question, doctor_response, recommendations
+            )
+            if modified_response is not None:
+                return modified_response
+
         return self.reconciliator(
             patient_question=patient_question,
             doctor_response=doctor_response,
@@ -4,16 +4,22 @@ import mlflow
 import logging
 import json
 from pathlib import Path
-from serde import to_dict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from importlib import import_module
+from functools import partial
 from models.prompt_score_v4 import (
     DoctorResponseScorerModule,
     field_to_evaluator,
+    group_metric,
+    make_fused_evaluator,
     metric_map,
     type_map,
 )
+from models.cascade import answer_confidence
 from mlflow.models import ModelSignature
 from configs.base import Config
+from utils.lm import build_lm
+from utils.concurrency import LMCallCap
 from dataloaders.prompt_score_v2_loader import PromptScoreV2Loader
 from optimizers.base import BaseOptimizer
 
@@ -25,14 +31,107 @@ def path_to_module(path: str):
     return path.rstrip(".py").replace("/", ".")
 
 
+def with_confidences(results, fields):
+    """Replaces the token logprobs of validation predictions with per-field answer confidences.
+
+    Only present when the LM returns logprobs (ModelSettings.logprobs), these are
+    what fit_cascade_thresholds.py fits the cascade thresholds on.
+    """
+    for _, prediction, _ in results:
+        if "logprobs" in prediction:
+            logprobs = prediction.pop("logprobs")
+            prediction["confidences"] = {
+                field: answer_confidence(logprobs, field) for field in fields
+            }
+    return results
+
+
+def optimize_unit(cfg: Config, dataloader, name, fields, is_group, parent_run_id):
+    """Optimizes the evaluator of one field or group of fields in its own nested MLflow run."""
+    with mlflow.start_run(run_name=name, nested=True, parent_run_id=parent_run_id):
+        print(f"\n\n{'='*50}")
+        print(f"Optimizing {name} evaluator")
+        print(f"{'='*50}")
+
+        if is_group:
+            predictor = cfg.predict_module(make_fused_evaluator(fields))
+            metric_fn = partial(group_metric, fields=fields)
+            optimizer_field, field_type = None, None
+        else:
+            predictor = cfg.predict_module(field_to_evaluator[name])
+            # Create optimizer with the corresponding metric function
+            metric_fn = metric_map.get(name, None)
+            optimizer_field, field_type = name, type_map[name]
+
+        assert cfg.optimizer
+        optimizer = cfg.optimizer(
+            field=optimizer_field, field_type=field_type, metric_fn=metric_fn
+        )
+
+        # Filter train and val examples that have labels for these fields
+        train_loader = dataloader.train_dataloader(fields)
+        val_loader = dataloader.val_dataloader(fields)
+        print(
+            f"Using {len(train_loader)} training examples and {len(val_loader)} validation examples for {name}"
+        )
+
+        # Optimize the predictor
+        (
+            optimized_model,
+            base_score,
+            results,
+            all_scores,
+            optimized_score,
+            optimized_results,
+            optimized_all_scores,
+        ) = optimizer.optimize(
+            predictor, train_set=train_loader, val_set=val_loader
+        )
+
+        result = {
+            "fields": fields,
+            "base_score": base_score,
+            "optimized_score": optimized_score,
+            "results": with_confidences(results, fields),
+            "all_scores": all_scores,
+            "optimized_results": with_confidences(optimized_results, fields),
+            "optimized_all_scores": optimized_all_scores,
+        }
+
+        print(f"Logging {name} model to MLflow...")
+        model_info = mlflow.dspy.log_model(  # type: ignore
+            optimized_model,
+            artifact_path=f"model_{name}",
+            code_paths=["models/prompt_score_v3.py"],
+        )
+        print(model_info.model_uri)
+
+        mlflow.log_metric("base_score", base_score)
+        mlflow.log_metric("optimized_score", optimized_score)
+        mlflow.log_metric("improvement", optimized_score - base_score)
+
+    return optimized_model, result, model_info.model_uri
+
+
 def main():
     parser = argparse.ArgumentParser(description="Optimize evaluator models")
     parser.add_argument("config_path", help="Path to the config file")
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help="Fields (or groups) optimized concurrently, sharing batch_concurrency LM calls",
+    )
+    parser.add_argument(
+        "--fields",
+        nargs="+",
+        help="Only re-optimize these fields or groups, the rest come from the checkpoint and output_path",
+    )
     args = parser.parse_args()
 
     cfg: Config = import_module(path_to_module(args.config_path)).config
 
-    dspy.settings.configure(lm=dspy.LM(**to_dict(cfg.model_settings)))
+    dspy.settings.configure(lm=build_lm(cfg.model_settings))
     dataloader = PromptScoreV2Loader(cfg=cfg)
 
     mlflow.set_tracking_uri(cfg.mlflow_url)
@@ -41,79 +140,99 @@ def main():
 
     result_dict = {}
 
-    with mlflow.start_run(run_name=cfg.run_name):
-        optimized_models = {}
-
-        for field, evaluator in field_to_evaluator.items():
-            print(f"\n\n{'='*50}")
-            print(f"Optimizing {field} evaluator")
-            print(f"{'='*50}")
+    # Groups of fields are optimized as a single composite evaluator, every
+    # other field with its own evaluator
+    groups = cfg.scorer_groups or {}
+    grouped_fields = {field for fields in groups.values() for field in fields}
+    units = {name: fields for name, fields in groups.items()}
+    for field in field_to_evaluator:
+        if field not in grouped_fields:
+            units[field] = [field]
+    if args.fields:
+        unknown = [name for name in args.fields if name not in units]
+        if unknown:
+            parser.error(f"unknown fields or groups {unknown}, choose from {list(units)}")
+        units = {name: units[name] for name in args.fields}
+        # The fields that aren't re-optimized come from the checkpoint, without it
+        # they would be saved back unoptimized
+        if not cfg.checkpoint_path or not Path(cfg.checkpoint_path).exists():
+            parser.error(f"--fields needs an existing checkpoint_path, got {cfg.checkpoint_path}")
+        # Earlier results of the fields that aren't re-optimized are kept
+        if Path(cfg.output_path).exists():
+            with open(cfg.output_path) as f:
+                result_dict = json.load(f)
 
-            predictor = cfg.predict_module(evaluator)
+    if args.jobs > 1:
+        # Every job runs its own threads, the cap keeps their sum off the server
+        dspy.settings.configure(
+            callbacks=[*dspy.settings.callbacks, LMCallCap(cfg.batch_concurrency)]
+        )
 
-            # Create optimizer with the corresponding metric function
-            metric_fn = metric_map.get(field, None)
-
-            assert cfg.optimizer
-            optimizer = cfg.optimizer(
-                field=field, field_type=type_map[field], metric_fn=metric_fn
-            )
-
-            # Filter train and val examples that have labels for this field
-            train_loader = dataloader.train_dataloader(field)
-            val_loader = dataloader.val_dataloader(field)
-            print(
-                f"Using {len(train_loader)} training examples and {len(val_loader)} validation examples for {field}"
-            )
-
-            # Optimize the predictor
-            (
-                optimized_model,
-                base_score,
-                results,
-                all_scores,
-                optimized_score,
-                optimized_results,
-                optimized_all_scores,
-            ) = optimizer.optimize(
-                predictor, train_set=train_loader, val_set=val_loader
-            )
-
-            result_dict[field] = {
-                "base_score": base_score,
-                "optimized_score": optimized_score,
-                "results": results,
-                "all_scores": all_scores,
-                "optimized_results": optimized_results,
-                "optimized_all_scores": optimized_all_scores,
-            }
+    def save_results():
+        Path(cfg.output_path).parent.mkdir(parents=True, exist_ok=True)
+        with open(cfg.output_path, "w") as f:
+            json.dump(result_dict, f)
 
-            optimized_models[field] = optimized_model
+    with mlflow.start_run(run_name=cfg.run_name) as run:
+        optimized_models = {}
+        optimized_groups = {}
+        failed = []
 
-            print(f"Logging {field} model to MLflow...")
-            artifact_path = f"model_{field}"
+        with ThreadPoolExecutor(max_workers=args.jobs) as pool:
+            futures = {
+                pool.submit(
+                    optimize_unit,
+                    cfg,
+                    dataloader,
+                    name,
+                    fields,
+                    name in groups,
+                    run.info.run_id,
+                ): name
+                for name, fields in units.items()
+            }
+            for future in as_completed(futures):
+                name = futures[future]
+                try:
+                    optimized_model, result, model_uri = future.result()
+                except Exception as e:
+                    # The other units keep going, their results are still saved
+                    print(f"Optimizing {name} failed: {e!r}")
+                    failed.append(name)
+                    continue
+                result_dict[name] = result
+                # Saved as each unit completes, so a crash keeps the finished ones
+                save_results()
 
-            model_info = mlflow.dspy.log_model(  # type: ignore
-                optimized_model,
-                artifact_path=artifact_path,
-                code_paths=["models/prompt_score_v3.py"],
-            )
-            print(model_info.model_uri)
+                if name in groups:
+                    optimized_groups[name] = optimized_model
+                else:
+                    optimized_models[name] = optimized_model
 
-            mlflow.log_param(f"model_uri_{field}", model_info.model_uri)
-            mlflow.log_metric(f"{field}_base_score", base_score)
-            mlflow.log_metric(f"{field}_optimized_score", optimized_score)
-            mlflow.log_metric(f"{field}_improvement", optimized_score - base_score)
+                base_score, optimized_score = result["base_score"], result["optimized_score"]
+                mlflow.log_param(f"model_uri_{name}", model_uri)
+                mlflow.log_metric(f"{name}_base_score", base_score)
+                mlflow.log_metric(f"{name}_optimized_score", optimized_score)
+                mlflow.log_metric(f"{name}_improvement", optimized_score - base_score)
 
         # Save result_dict
         print("SAVED FIELDS:")
         print(optimized_models.keys())
-        Path(cfg.output_path).parent.mkdir(parents=True, exist_ok=True)
-        with open(cfg.output_path, "w") as f:
-            json.dump(result_dict, f)
+        print("SAVED GROUPS:")
+        print(optimized_groups.keys())
+        save_results()
+        if failed:
+            mlflow.log_param("failed_units", ",".join(failed))
         # Create a combined scorer with all optimized models
-        optimized_scorer = DoctorResponseScorerModule(cfg)
-        optimized_scorer.scorers = optimized_models
+        # Grouped fields keep their unoptimized evaluator as a parse failure fallback
+        if args.fields:
+            # Fields that weren't re-optimized keep their checkpointed evaluators
+            optimized_scorer = dspy.load(cfg.checkpoint_path)
+            optimized_scorer.apply_config(cfg)
+        else:
+            optimized_scorer = DoctorResponseScorerModule(cfg)
+        optimized_scorer.scorers.update(optimized_models)
+        optimized_scorer.fused_scorers.update(optimized_groups)
         if cfg.checkpoint_path:
             optimized_scorer.save(cfg.checkpoint_path, save_program=True)
 
@@ -131,6 +250,11 @@ def main():
 
         print("\nOptimization complete!")
 
+    if failed:
+        # Failed units keep their unoptimized evaluator in the checkpoint
+        print(f"Failed to optimize {failed}, re-run them with --fields {' '.join(failed)}")
+        raise SystemExit(1)
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,140 @@
+import json
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from configs.base import EjectionSettings
+from utils.balancer import BalancedLM, balancer_stats
+
+
+class StubServer:
+    """OpenAI-compatible chat endpoint answering with its own name, or failing with `status`."""
+
+    def __init__(self, name: str, status: int = 200, delay: float = 0.0):
+        self.name = name
+        self.status = status
+        self.delay = delay
+        self.requests = 0
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers["Content-Length"]))
+                stub.requests += 1
+                time.sleep(stub.delay)
+                if stub.status != 200:
+                    body = json.dumps({"error": {"message": "unavailable"}}).encode()
+                else:
+                    body = json.dumps(
+                        {
+                            "id": "stub",
+                            "object": "chat.completion",
+                            "created": 0,
+                            "model": "stub",
+                            "choices": [
+                                {
+                                    "index": 0,
+                                    "finish_reason": "stop",
+                                    "message": {"role": "assistant", "content": stub.name},
+                                }
+                            ],
+                            "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2},
+                        }
+                    ).encode()
+                self.send_response(stub.status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.api_base = f"http://127.0.0.1:{self.server.server_port}/v1"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def balanced_lm(servers, **ejection):
+    return BalancedLM(
+        "hosted_vllm/stub",
+        [server.api_base for server in servers],
+        ejection=EjectionSettings(**ejection),
+        api_key="stub",
+        cache=False,
+    )
+
+
+def ask(lm, content="question"):
+    return lm(messages=[{"role": "user", "content": content}])[0]
+
+
+class BalancedLMTest(unittest.TestCase):
+    def setUp(self):
+        self.servers = []
+
+    def tearDown(self):
+        for server in self.servers:
+            server.close()
+
+    def stub(self, name, **kwargs):
+        server = StubServer(name, **kwargs)
+        self.servers.append(server)
+        return server
+
+    def test_picks_replica_with_fewest_outstanding(self):
+        lm = balanced_lm([self.stub("a"), self.stub("b")])
+        first = lm.pick([])
+        second = lm.pick([])
+        self.assertIsNot(first, second)
+        lm.done(first, time.perf_counter(), error=False)
+        self.assertIs(lm.pick([]), first)
+
+    def test_spreads_concurrent_requests(self):
+        a, b = self.stub("a", delay=0.2), self.stub("b", delay=0.2)
+        lm = balanced_lm([a, b])
+        threads = [threading.Thread(target=ask, args=(lm, str(i))) for i in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual((a.requests, b.requests), (3, 3))
+
+    def test_retries_on_next_replica(self):
+        down, up = self.stub("down", status=503), self.stub("up")
+        lm = balanced_lm([down, up])
+        self.assertEqual(ask(lm), "up")
+        self.assertEqual(down.requests, 1)
+        stats = lm.stats()
+        self.assertEqual(stats[down.api_base]["failures"], 1)
+        self.assertEqual(stats[up.api_base]["failures"], 0)
+
+    def test_ejects_failing_replica(self):
+        down, up = self.stub("down", status=503), self.stub("up")
+        lm = balanced_lm([down, up], max_failures=2, ejection_seconds=60.0)
+        for i in range(6):
+            self.assertEqual(ask(lm, str(i)), "up")
+        # Ejected after its second consecutive failure, not tried again
+        self.assertEqual(down.requests, 2)
+        self.assertEqual(lm.stats()[down.api_base]["ejections"], 1)
+
+    def test_raises_when_every_replica_fails(self):
+        lm = balanced_lm([self.stub("a", status=503), self.stub("b", status=503)])
+        with self.assertRaises(Exception):
+            ask(lm)
+
+    def test_stats_keep_pools_of_the_same_model_apart(self):
+        a, b = self.stub("a"), self.stub("b")
+        balanced_lm([a])
+        balanced_lm([b])
+        pools = [set(replicas) for replicas in balancer_stats().values()]
+        self.assertIn({a.api_base}, pools)
+        self.assertIn({b.api_base}, pools)
+
+
+if __name__ == "__main__":
+    unittest.main()
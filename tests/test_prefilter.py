@@ -0,0 +1,22 @@
+import unittest
+from models.prefilter import no_abbreviations
+
+
+class NoAbbreviationsTest(unittest.TestCase):
+    def test_decides_plain_text(self):
+        self.assertIs(no_abbreviations("", "Bună ziua, mergeți la medicul de familie."), False)
+
+    def test_defers_on_forms_of_address_and_units(self):
+        for response in [
+            "Stimată d-nă, revin.",
+            "Vă rog d-voastră să reveniți.",
+            "Luați 500 mg seara.",
+            "Luați 500mg seara.",
+            "Câte 1 cp pe zi.",
+        ]:
+            with self.subTest(response=response):
+                self.assertIsNone(no_abbreviations("", response))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,61 @@
+import unittest
+from utils.text import affected_sentences, apply_edits, split_sentences
+
+
+def sentences(text):
+    return [text[start:end] for start, end in split_sentences(text)]
+
+
+class SplitSentencesTest(unittest.TestCase):
+    def test_splits_on_final_punctuation_and_lines(self):
+        self.assertEqual(
+            sentences("Bună ziua! Ce vârstă aveți?\nVă rog reveniți..."),
+            ["Bună ziua!", "Ce vârstă aveți?", "Vă rog reveniți..."],
+        )
+
+    def test_keeps_decimals_and_titles_in_their_sentence(self):
+        self.assertEqual(
+            sentences("Luați 2.5 mg pe zi. Dr. Pop vă sună."),
+            ["Luați 2.5 mg pe zi.", "Dr. Pop vă sună."],
+        )
+
+    def test_abbreviation_must_be_a_whole_word(self):
+        self.assertEqual(
+            sentences("Tratamentul e complex. Revin cu detalii."),
+            ["Tratamentul e complex.", "Revin cu detalii."],
+        )
+
+    def test_affected_sentences_keep_decimals(self):
+        old = "Luați 2.5 mg pe zi. Dr. Pop vă sună."
+        new = "Luați 2.75 mg pe zi. Dr. Pop vă sună."
+        self.assertEqual(
+            [new[start:end] for start, end in affected_sentences(old, new)],
+            ["Luați 2.75 mg pe zi."],
+        )
+
+
+RESPONSE = "Durerea poate fi cauzată de stres.  Vă recomand să beți apă. Mergeți la medic."
+
+
+class ApplyEditsTest(unittest.TestCase):
+    def test_applies_exact_quotes(self):
+        self.assertEqual(
+            apply_edits(RESPONSE, [("să beți apă", "să beți multă apă"), ("medic.", "medicul de familie.")]),
+            "Durerea poate fi cauzată de stres.  Vă recomand să beți multă apă. Mergeți la medicul de familie.",
+        )
+
+    def test_locates_quotes_with_other_whitespace_or_diacritics(self):
+        self.assertEqual(
+            apply_edits(RESPONSE, [("cauzata de stres. Va recomand", "cauzată de oboseală. Vă sfătuiesc")]),
+            "Durerea poate fi cauzată de oboseală. Vă sfătuiesc să beți apă. Mergeți la medic.",
+        )
+
+    def test_rejects_ambiguous_missing_or_overlapping_quotes(self):
+        self.assertIsNone(apply_edits(RESPONSE, [("ți", "ți-")]))
+        self.assertIsNone(apply_edits(RESPONSE, [("Faceți o tomografie computerizată", "")]))
+        self.assertIsNone(apply_edits(RESPONSE, [("", "Bună ziua.")]))
+        self.assertIsNone(apply_edits(RESPONSE, [("beți apă", "x"), ("apă.", "y")]))
+
+
+if __name__ == "__main__":
+    unittest.main()
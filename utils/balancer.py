@@ -0,0 +1,160 @@
+import threading
+import time
+import dspy
+import litellm
+from typing import Dict, List, Optional
+from configs.base import EjectionSettings
+
+# Errors that say something about the replica rather than about the request
+REPLICA_ERRORS = (
+    litellm.APIConnectionError,
+    litellm.Timeout,
+    litellm.ServiceUnavailableError,
+    litellm.InternalServerError,
+)
+
+
+class Replica:
+    def __init__(self, api_base: str):
+        self.api_base = api_base
+        self.outstanding = 0
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.ejections = 0
+        self.total_latency = 0.0
+        self.ejected_until = 0.0
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "requests": self.requests,
+            "failures": self.failures,
+            "outstanding": self.outstanding,
+            "ejections": self.ejections,
+            "mean_latency": self.total_latency / self.requests if self.requests else 0.0,
+        }
+
+
+# Every balanced LM, for balancer_stats
+_balanced_lms: List["BalancedLM"] = []
+
+
+class BalancedLM(dspy.LM):
+    """dspy.LM spread over replicas of the same model, see ModelSettings.api_base.
+
+    Each request goes to the healthy replica with the fewest outstanding
+    requests. Health checks are passive: after `max_failures` consecutive
+    connection or server errors a replica is ejected for `ejection_seconds`,
+    after which a single further failure ejects it again. A failed request is
+    retried on the next replica instead of by LiteLLM on the same one.
+    """
+
+    def __init__(
+        self,
+        model: str,
+        api_bases: List[str],
+        ejection: Optional[EjectionSettings] = None,
+        num_retries: int = 0,
+        **kwargs,
+    ):
+        super().__init__(model, num_retries=num_retries, **kwargs)
+        self.replicas = [Replica(api_base) for api_base in api_bases]
+        self.ejection = ejection or EjectionSettings()
+        self._lock = threading.Lock()
+        _balanced_lms.append(self)
+
+    def __getstate__(self):
+        # Locks can't be pickled or deep copied (LM.copy), a new one is made
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def pick(self, tried: List[Replica]) -> Replica:
+        now = time.monotonic()
+        with self._lock:
+            candidates = [replica for replica in self.replicas if replica not in tried]
+            healthy = [replica for replica in candidates if replica.ejected_until <= now]
+            # With every replica ejected, the one back soonest is better than failing
+            pool = healthy or [min(candidates, key=lambda replica: replica.ejected_until)]
+            replica = min(pool, key=lambda replica: (replica.outstanding, replica.requests))
+            replica.outstanding += 1
+            replica.requests += 1
+            return replica
+
+    def done(self, replica: Replica, started_at: float, error: Optional[bool]):
+        """Records a finished request, error=None for errors that aren't the replica's fault."""
+        with self._lock:
+            replica.outstanding -= 1
+            replica.total_latency += time.perf_counter() - started_at
+            if error is None:
+                return
+            if not error:
+                replica.consecutive_failures = 0
+                return
+            replica.failures += 1
+            replica.consecutive_failures += 1
+            # An ejected replica that fails its first request again goes straight back out
+            if replica.consecutive_failures >= self.ejection.max_failures:
+                now = time.monotonic()
+                if replica.ejected_until <= now:
+                    replica.ejections += 1
+                replica.ejected_until = now + self.ejection.ejection_seconds
+
+    def forward(self, prompt=None, messages=None, **kwargs):
+        tried = []
+        while True:
+            replica = self.pick(tried)
+            started_at = time.perf_counter()
+            try:
+                result = super().forward(
+                    prompt=prompt, messages=messages, api_base=replica.api_base, **kwargs
+                )
+            except REPLICA_ERRORS:
+                self.done(replica, started_at, error=True)
+                tried.append(replica)
+                if len(tried) == len(self.replicas):
+                    raise
+                continue
+            except Exception:
+                self.done(replica, started_at, error=None)
+                raise
+            self.done(replica, started_at, error=False)
+            return result
+
+    async def aforward(self, prompt=None, messages=None, **kwargs):
+        tried = []
+        while True:
+            replica = self.pick(tried)
+            started_at = time.perf_counter()
+            try:
+                result = await super().aforward(
+                    prompt=prompt, messages=messages, api_base=replica.api_base, **kwargs
+                )
+            except REPLICA_ERRORS:
+                self.done(replica, started_at, error=True)
+                tried.append(replica)
+                if len(tried) == len(self.replicas):
+                    raise
+                continue
+            except Exception:
+                self.done(replica, started_at, error=None)
+                raise
+            self.done(replica, started_at, error=False)
+            return result
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        with self._lock:
+            return {replica.api_base: replica.stats() for replica in self.replicas}
+
+
+def balancer_stats() -> Dict[str, Dict[str, Dict[str, float]]]:
+    """Per-replica request counts and latency of every balanced LM.
+
+    Keyed by model and creation order, like limiter_stats, so pools of the
+    same model each keep their own entry.
+    """
+    return {f"{lm.model}_lm{index}": lm.stats() for index, lm in enumerate(_balanced_lms)}
@@ -0,0 +1,254 @@
+import asyncio
+import threading
+import time
+import dspy
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+from dspy.utils.callback import BaseCallback
+from tqdm import tqdm
+from configs.base import ConcurrencySettings
+from utils.jsonl import append_jsonl, open_for_append, read_jsonl
+
+
+class AdaptiveConcurrencyLimiter:
+    """Bounds the number of in-flight LM calls and adapts the bound AIMD-style.
+
+    The limit grows by one after a full window of successful calls faster than
+    `latency_target` and is multiplied by `backoff` after an error or a slow call.
+    """
+
+    def __init__(self, settings: ConcurrencySettings):
+        self.settings = settings
+        self.limit = float(settings.initial_limit)
+        self.in_flight = 0
+        self.calls = 0
+        self.errors = 0
+        self._window = 0
+        self._last_backoff = 0.0
+        self._waiters = deque()
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._waiters)
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "limit": int(self.limit),
+            "in_flight": self.in_flight,
+            "queue_depth": self.queue_depth,
+            "calls": self.calls,
+            "errors": self.errors,
+        }
+
+    async def acquire(self):
+        while self.in_flight >= int(self.limit):
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                # Pass on a wake up this waiter can no longer use
+                if waiter.done() and not waiter.cancelled():
+                    self._wake()
+                raise
+            finally:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+        self.in_flight += 1
+
+    def release(self, started_at: float, error: bool):
+        self.in_flight -= 1
+        self.calls += 1
+        self.errors += int(error)
+
+        latency = time.monotonic() - started_at
+        if error or latency > self.settings.latency_target:
+            # Calls started before the last backoff already saw the old limit
+            if started_at >= self._last_backoff:
+                self.limit = max(
+                    self.settings.min_limit, self.limit * self.settings.backoff
+                )
+                self._last_backoff = time.monotonic()
+            self._window = 0
+        else:
+            self._window += 1
+            if self._window >= self.limit:
+                self.limit = min(self.settings.max_limit, self.limit + 1)
+                self._window = 0
+
+        self._wake()
+
+    def _wake(self):
+        free = int(self.limit) - self.in_flight
+        for waiter in list(self._waiters)[: max(free, 0)]:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    @asynccontextmanager
+    async def slot(self):
+        await self.acquire()
+        started_at = time.monotonic()
+        error = False
+        try:
+            yield
+        except Exception:
+            error = True
+            raise
+        finally:
+            self.release(started_at, error)
+
+
+# id(lm) -> (lm, limiter), the LM is kept so its id is never reused
+_limiters: Dict[int, Tuple[dspy.LM, AdaptiveConcurrencyLimiter]] = {}
+
+
+def attach_limiter(lm: dspy.LM, settings: ConcurrencySettings) -> AdaptiveConcurrencyLimiter:
+    limiter = AdaptiveConcurrencyLimiter(settings)
+    _limiters[id(lm)] = (lm, limiter)
+    return limiter
+
+
+def get_limiter(lm: Optional[dspy.LM] = None) -> Optional[AdaptiveConcurrencyLimiter]:
+    lm = lm or dspy.settings.lm
+    entry = _limiters.get(id(lm))
+    return entry[1] if entry is not None else None
+
+
+def limiter_stats() -> Dict[str, Dict[str, float]]:
+    """Current limit, in-flight calls and queue depth of every registered LM.
+
+    Keyed by model and registration order, LMs of the same model on different
+    endpoints each keep their own entry.
+    """
+    return {
+        f"{lm.model}_lm{index}": limiter.stats()
+        for index, (lm, limiter) in enumerate(_limiters.values())
+    }
+
+
+# Bound on the LM calls of a batch, set by run_batch for the tasks it starts
+_batch_slots: ContextVar[Optional[asyncio.Semaphore]] = ContextVar(
+    "batch_slots", default=None
+)
+
+
+@contextmanager
+def bounded_calls(max_concurrency: int):
+    """LM calls of tasks started inside the block share `max_concurrency` slots."""
+    token = _batch_slots.set(asyncio.Semaphore(max_concurrency))
+    try:
+        yield
+    finally:
+        _batch_slots.reset(token)
+
+
+@asynccontextmanager
+async def lm_slot(lm: Optional[dspy.LM] = None):
+    """Holds a concurrency slot of `lm` (default: the configured LM) for one call.
+
+    Inside a batch (run_batch) the call first waits for a slot of the batch.
+    """
+    batch_slots = _batch_slots.get()
+    if batch_slots is not None:
+        await batch_slots.acquire()
+    try:
+        limiter = get_limiter(lm)
+        if limiter is None:
+            yield
+            return
+        async with limiter.slot():
+            yield
+    finally:
+        if batch_slots is not None:
+            batch_slots.release()
+
+
+async def run_batch(
+    coroutines: Iterable[Awaitable],
+    max_concurrency: int,
+    on_done: Optional[Callable[[], Any]] = None,
+) -> List[Any]:
+    """Runs every coroutine at once, with at most `max_concurrency` LM calls in flight.
+
+    The bound is shared by all the (sample x field) calls of the batch, so the
+    server stays busy however the calls are spread over samples. Results are in
+    input order, a coroutine that raised has its exception in place of its result.
+    """
+    with bounded_calls(max_concurrency):
+        tasks = [asyncio.ensure_future(coroutine) for coroutine in coroutines]
+    if on_done is not None:
+        for task in tasks:
+            task.add_done_callback(lambda _: on_done())
+    return await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def run_resumable(
+    samples: Iterable[Any],
+    output_path: str,
+    process_sample: Callable[[Any], Awaitable[Dict[str, Any]]],
+    max_concurrency: int,
+    on_progress: Optional[Callable[[tqdm], Any]] = None,
+) -> Path:
+    """Runs `process_sample` on every sample not already done, see run_batch.
+
+    Each result is appended to a JSON Lines file next to `output_path` as soon
+    as its sample is done, with the error instead if it raised. A restarted run
+    skips the samples that already succeeded. Returns the JSON Lines path.
+    """
+    output_path = Path(output_path)
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    jsonl_path = output_path.with_suffix(".jsonl")
+    done = set()
+    if jsonl_path.exists():
+        done = {
+            record["base_id"] for record in read_jsonl(jsonl_path) if "error" not in record
+        }
+    samples = [sample for sample in samples if sample.base_id not in done]
+    print(f"Skipping {len(done)} samples already in {jsonl_path}")
+    progress = tqdm(total=len(samples))
+
+    with open_for_append(jsonl_path) as jsonl_file:
+
+        async def process(sample):
+            result = {
+                "base_id": sample.base_id,
+                "patient_question": sample.patient_question,
+                "doctor_response": sample.doctor_response,
+            }
+            try:
+                result.update(await process_sample(sample))
+            except Exception as e:
+                result["error"] = repr(e)
+            append_jsonl(jsonl_file, result)
+            progress.update()
+            if on_progress is not None:
+                on_progress(progress)
+
+        await run_batch([process(sample) for sample in samples], max_concurrency)
+    progress.close()
+    return jsonl_path
+
+
+class LMCallCap(BaseCallback):
+    """dspy callback bounding the LM calls in flight across every thread.
+
+    Sync callers (e.g. optimizers running side by side) block until a call
+    slot is free. Async code bounds its calls with lm_slot instead.
+    """
+
+    def __init__(self, max_calls: int):
+        self._slots = threading.BoundedSemaphore(max_calls)
+
+    def on_lm_start(self, call_id: str, instance: Any, inputs: Dict[str, Any]):
+        self._slots.acquire()
+
+    def on_lm_end(
+        self,
+        call_id: str,
+        outputs: Optional[Dict[str, Any]],
+        exception: Optional[Exception] = None,
+    ):
+        self._slots.release()
@@ -0,0 +1,56 @@
+import json
+import os
+from typing import Any, Dict, Iterator, TextIO
+
+
+def read_jsonl(path: str) -> Iterator[Dict[str, Any]]:
+    """Records of a JSON Lines file. A truncated last line, e.g. from a crash, is skipped.
+
+    Lines are decoded one by one, a crash can cut a multi-byte character in half.
+    """
+    with open(path, "rb") as f:
+        for line in f:
+            try:
+                yield json.loads(line.decode("utf-8"))
+            except (UnicodeDecodeError, json.JSONDecodeError):
+                continue
+
+
+def open_for_append(path: str) -> TextIO:
+    """Opens a JSON Lines file for appending, after the last complete record."""
+    with open(path, "ab+") as f:
+        if f.tell() > 0:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b"\n":
+                # A record cut short by a crash must not swallow the next one
+                f.write(b"\n")
+    return open(path, "a", encoding="utf-8")
+
+
+def append_jsonl(f: TextIO, record: Dict[str, Any]):
+    """Writes one record and flushes it, so it survives a crash of the process."""
+    f.write(json.dumps(record, ensure_ascii=False) + "\n")
+    f.flush()
+
+
+def jsonl_to_json(jsonl_path: str, json_path: str, key: str) -> Dict[str, int]:
+    """Writes the last record of every `key` as a JSON array, record by record.
+
+    Returns the number of records written and how many of them have an "error".
+    """
+    last_line = {}
+    for line_number, record in enumerate(read_jsonl(jsonl_path)):
+        last_line[record[key]] = line_number
+
+    written, failed = 0, 0
+    with open(json_path, "w") as f:
+        f.write("[")
+        for line_number, record in enumerate(read_jsonl(jsonl_path)):
+            if last_line[record[key]] != line_number:
+                continue
+            f.write(", " if written else "")
+            json.dump(record, f)
+            written += 1
+            failed += "error" in record
+        f.write("]")
+    return {"written": written, "failed": failed}
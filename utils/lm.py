@@ -0,0 +1,36 @@
+import dspy
+import json
+from typing import Dict
+from serde import to_dict
+from configs.base import ModelSettings
+from utils.balancer import BalancedLM
+from utils.concurrency import attach_limiter
+
+
+def build_lm(settings: ModelSettings) -> dspy.LM:
+    """Builds the dspy.LM described by `settings` and registers its concurrency limiter."""
+    kwargs = to_dict(settings)
+    kwargs.pop("concurrency")
+    kwargs.pop("ejection")
+    if not kwargs["logprobs"]:
+        kwargs.pop("logprobs")
+    if isinstance(settings.api_base, list):
+        kwargs["api_bases"] = kwargs.pop("api_base")
+        lm = BalancedLM(ejection=settings.ejection, **kwargs)
+    else:
+        lm = dspy.LM(**kwargs)
+    if settings.concurrency is not None:
+        attach_limiter(lm, settings.concurrency)
+    return lm
+
+
+# Serialized settings -> LM, so components pointed at the same endpoint share one budget
+_shared_lms: Dict[str, dspy.LM] = {}
+
+
+def shared_lm(settings: ModelSettings) -> dspy.LM:
+    """Like build_lm, but returns the same LM for equal settings."""
+    key = json.dumps(to_dict(settings), sort_keys=True)
+    if key not in _shared_lms:
+        _shared_lms[key] = build_lm(settings)
+    return _shared_lms[key]
@@ -0,0 +1,134 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+import dspy
+from typing import Any, Dict, Optional
+from configs.base import ScoreStoreSettings
+
+
+def program_hash(program: dspy.Module) -> str:
+    """Hashes everything that changes what a program predicts: instructions, fields, demos and LM."""
+    state = {}
+    for name, predictor in program.named_predictors():
+        predictor_state = predictor.dump_state()
+        lm = predictor.lm or dspy.settings.lm
+        state[name] = {
+            "signature": predictor_state["signature"],
+            "demos": predictor_state["demos"],
+            "lm": lm.model if lm is not None else None,
+        }
+    payload = json.dumps(state, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ScoreStore:
+    """SQLite backed store of parsed field scores.
+
+    Entries are keyed by (field, program hash, patient question, doctor response), so a
+    new checkpoint only invalidates the fields whose program changed. Entries expire
+    after `ttl_seconds` and the least recently used ones are evicted above `max_entries`.
+    """
+
+    # Eviction runs every EVICT_EVERY writes rather than on each one
+    EVICT_EVERY = 100
+
+    def __init__(self, settings: ScoreStoreSettings):
+        self.settings = settings
+        self.hits = 0
+        self.misses = 0
+        self._puts = 0
+        self._connection = None
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # Connections and locks can't be pickled, they are reopened on first use
+        state = self.__dict__.copy()
+        state["_connection"] = None
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        if self._connection is None:
+            self._connection = sqlite3.connect(
+                self.settings.path, isolation_level=None, check_same_thread=False
+            )
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS scores ("
+                "key TEXT PRIMARY KEY, field TEXT, value TEXT, "
+                "created_at REAL, accessed_at REAL)"
+            )
+            self._connection.execute(
+                "CREATE INDEX IF NOT EXISTS scores_accessed_at ON scores (accessed_at)"
+            )
+        return self._connection
+
+    @staticmethod
+    def key(
+        field: str, program_hash: str, patient_question: str, doctor_response: str
+    ) -> str:
+        payload = json.dumps(
+            [field, program_hash, patient_question, doctor_response], ensure_ascii=False
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[Any]:
+        """Returns the stored value, or None on a miss."""
+        now = time.time()
+        with self._lock:
+            row = self.connection.execute(
+                "SELECT value, created_at FROM scores WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None and self._expired(row[1], now):
+                self.connection.execute("DELETE FROM scores WHERE key = ?", (key,))
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self.connection.execute(
+                "UPDATE scores SET accessed_at = ? WHERE key = ?", (now, key)
+            )
+            self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, key: str, field: str, value: Any):
+        now = time.time()
+        with self._lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO scores VALUES (?, ?, ?, ?, ?)",
+                (key, field, json.dumps(value), now, now),
+            )
+            self._puts += 1
+            if self._puts % self.EVICT_EVERY == 0:
+                self._evict(now)
+
+    def _expired(self, created_at: float, now: float) -> bool:
+        return (
+            self.settings.ttl_seconds is not None
+            and now - created_at > self.settings.ttl_seconds
+        )
+
+    def _evict(self, now: float):
+        if self.settings.ttl_seconds is not None:
+            self.connection.execute(
+                "DELETE FROM scores WHERE created_at < ?",
+                (now - self.settings.ttl_seconds,),
+            )
+        if self.settings.max_entries is not None:
+            (count,) = self.connection.execute("SELECT COUNT(*) FROM scores").fetchone()
+            if count > self.settings.max_entries:
+                self.connection.execute(
+                    "DELETE FROM scores WHERE key IN "
+                    "(SELECT key FROM scores ORDER BY accessed_at LIMIT ?)",
+                    (count - self.settings.max_entries,),
+                )
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses}
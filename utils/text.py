@@ -0,0 +1,142 @@
+import re
+from typing import List, Optional, Sequence, Tuple
+from diff_match_patch import diff_match_patch
+
+Span = Tuple[int, int]
+
+# Abbreviations commonly found in Romanian medical answers
+ABBREVIATION_LEXICON = [
+    "dvs", "dv", "dl", "dna", "dr", "ex", "etc", "nr", "pt", "cca", "aprox",
+    "buc", "cp", "tb", "inj", "max", "min", "sapt",
+]
+
+# A sentence runs up to its final punctuation or the end of the line
+SENTENCE_END_PATTERN = re.compile(r"[.!?…]+|\n")
+WORD_BEFORE_PATTERN = re.compile(r"\w+$")
+
+
+def _continues_sentence(text: str, dot: int) -> bool:
+    """Whether the period at `dot` is part of a decimal ("2.5") or an abbreviation ("Dr.")."""
+    if 0 < dot < len(text) - 1 and text[dot - 1].isdigit() and text[dot + 1].isdigit():
+        return True
+    word = WORD_BEFORE_PATTERN.search(text, max(0, dot - 10), dot)
+    return (
+        word is not None
+        and (word.start() == 0 or not text[word.start() - 1].isalnum())
+        and word.group().lower() in ABBREVIATION_LEXICON
+    )
+
+
+def split_sentences(text: str) -> List[Span]:
+    """Returns the (start, end) offsets of every sentence in `text`."""
+    spans = []
+    start = 0
+    for match in SENTENCE_END_PATTERN.finditer(text):
+        if match.group() == "." and _continues_sentence(text, match.start()):
+            continue
+        end = match.start() if match.group() == "\n" else match.end()
+        while start < end and text[start].isspace():
+            start += 1
+        if start < end:
+            spans.append((start, end))
+        start = match.end()
+    while start < len(text) and text[start].isspace():
+        start += 1
+    if start < len(text):
+        spans.append((start, len(text)))
+    return spans
+
+
+def changed_spans(old: str, new: str) -> List[Span]:
+    """Returns the spans of `new` that were inserted or replaced with respect to `old`.
+
+    A pure deletion is reported as an empty span at the position it happened.
+    """
+    dmp = diff_match_patch()
+    diffs = dmp.diff_main(old, new)
+    dmp.diff_cleanupSemantic(diffs)
+
+    spans = []
+    position = 0
+    for operation, text in diffs:
+        if operation == dmp.DIFF_INSERT:
+            spans.append((position, position + len(text)))
+            position += len(text)
+        elif operation == dmp.DIFF_DELETE:
+            spans.append((position, position))
+        else:
+            position += len(text)
+    return spans
+
+
+def affected_sentences(old: str, new: str) -> List[Span]:
+    """Returns the sentences of `new` touched by an edit of `old`."""
+    changes = changed_spans(old, new)
+    return [
+        (start, end)
+        for start, end in split_sentences(new)
+        if any(
+            change_start <= end and change_end >= start
+            for change_start, change_end in changes
+        )
+    ]
+
+
+# Most edits (errors / length) a near-miss quote can be from the text it is matched to
+MAX_QUOTE_ERRORS = 0.2
+
+
+def locate_quote(text: str, quote: str) -> Optional[Span]:
+    """Returns the span of `text` that `quote` was copied from, None when it can't be told.
+
+    An exact quote has to occur only once. A quote that doesn't occur exactly,
+    e.g. with different whitespace or diacritics, is located with
+    diff-match-patch's fuzzy matching and accepted when it differs from the
+    matched text in at most MAX_QUOTE_ERRORS of its characters.
+    """
+    if not quote or text.count(quote) > 1:
+        return None
+    start = text.find(quote)
+    if start >= 0:
+        return start, start + len(quote)
+
+    dmp = diff_match_patch()
+    dmp.Match_Threshold = MAX_QUOTE_ERRORS
+    # Anywhere in the text is as likely, only the errors count
+    dmp.Match_Distance = 10**9
+    start = dmp.match_main(text, quote[: dmp.Match_MaxBits], 0)
+    if start < 0:
+        return None
+    # The end of the quote is found by diffing it with the text around it
+    window = text[start : start + len(quote) + len(quote) // 4 + 8]
+    end = start + dmp.diff_xIndex(dmp.diff_main(quote, window), len(quote) - 1) + 1
+    errors = dmp.diff_levenshtein(dmp.diff_main(quote, text[start:end]))
+    if errors > len(quote) * MAX_QUOTE_ERRORS:
+        return None
+    return start, end
+
+
+def apply_edits(text: str, edits: Sequence[Tuple[str, str]]) -> Optional[str]:
+    """Applies (original, replacement) edits to `text`.
+
+    Every original is located with locate_quote, so it can be a near-miss
+    quote of `text` but not an ambiguous one. Edits can't overlap. Returns None
+    when an edit can't be located.
+    """
+    located = []
+    for original, replacement in edits:
+        span = locate_quote(text, original)
+        if span is None:
+            return None
+        located.append((*span, replacement))
+    located.sort()
+
+    parts = []
+    position = 0
+    for start, end, replacement in located:
+        if start < position:
+            return None
+        parts += [text[position:start], replacement]
+        position = end
+    parts.append(text[position:])
+    return "".join(parts)
@@ -0,0 +1,54 @@
+import copy
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, List, TypeVar
+from dspy.dsp.utils.settings import thread_local_overrides
+from dspy.dsp.utils.utils import dotdict
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+# One pool per worker count, shared by every sync forward of the process
+_pools: Dict[int, ThreadPoolExecutor] = {}
+_pools_lock = threading.Lock()
+_worker = threading.local()
+
+
+def get_pool(workers: int) -> ThreadPoolExecutor:
+    with _pools_lock:
+        if workers not in _pools:
+            _pools[workers] = ThreadPoolExecutor(
+                max_workers=workers, thread_name_prefix="dspy-forward"
+            )
+        return _pools[workers]
+
+
+def parallel_map(function: Callable[[T], R], items: Iterable[T], workers: int) -> List[R]:
+    """Maps `function` over `items` on a shared thread pool, results in order.
+
+    Workers run with the caller's dspy.context overrides (lm, adapter, ...), like
+    dspy's ParallelExecutor. Calls made from inside a pool worker run serially,
+    so nested sync forwards can't deadlock the pool.
+    """
+    items = list(items)
+    if workers <= 1 or len(items) <= 1 or getattr(_worker, "active", False):
+        return [function(item) for item in items]
+
+    parent_overrides = getattr(thread_local_overrides, "overrides", dotdict()).copy()
+
+    def run(item):
+        original = getattr(thread_local_overrides, "overrides", dotdict())
+        thread_local_overrides.overrides = parent_overrides.copy()
+        if parent_overrides.get("usage_tracker"):
+            # Every thread tracks its own usage, as in dspy's ParallelExecutor
+            thread_local_overrides.overrides["usage_tracker"] = copy.deepcopy(
+                parent_overrides["usage_tracker"]
+            )
+        _worker.active = True
+        try:
+            return function(item)
+        finally:
+            _worker.active = False
+            thread_local_overrides.overrides = original
+
+    return list(get_pool(workers).map(run, items))